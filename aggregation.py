@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Hourly (Sensor_data_60) and daily (Sensor_data_1440) averages for all
+sensors at once. Averages are computed either in pandas (hourly_averages,
+daily_averages) or inside PostgreSQL (sql_rollup), with the same labels.
+
+@author: Taneli Mäkelä
+"""
+import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, or_, text
+from watermarks import TARGETS
+
+MEASUREMENTS = ['no2', 'no', 'o3', 'pm10', 'pm25', 'pm1', 'co', 'temp', 'rh', 'pres']
+FLAGS = [column + '_flag' for column in MEASUREMENTS]
+
+
+def hour_bucket(timestamps):
+    # resample('H', label='right'): [10:00, 11:00) is labelled 11:00
+    return timestamps.dt.floor('H') + datetime.timedelta(hours=1)
+
+
+def day_bucket(timestamps):
+    # resample('D', offset=1, label='left') of right labelled hours:
+    # hours 01:00 ... 24:00 of day D are labelled D
+    return timestamps.dt.ceil('D') - datetime.timedelta(days=1)
+
+
+# Rollup tables: target table -> (source table, bucket)
+ROLLUPS = {'Sensor_data_60': ('Sensor_data', 'hour'), 'Sensor_data_1440': ('Sensor_data_60', 'day')}
+
+# Label function of each bucket and the source rows of label L, which are
+# between L + first and L + last (both inclusive)
+BUCKETS = {'hour': (hour_bucket, datetime.timedelta(hours=-1), datetime.timedelta(minutes=-1)),
+           'day': (day_bucket, datetime.timedelta(minutes=1), datetime.timedelta(days=1))}
+
+
+# Most ranges in one statement. Each range is an OR clause of read_pending
+# and a VALUES row of rollup_statement, so longer lists are split.
+MAX_RANGES = 500
+
+
+def batches(ranges, size=MAX_RANGES):
+    for i in range(0, len(ranges), size):
+        yield ranges[i:i + size]
+
+
+def read_pending(session, table, ranges):
+    '''
+    Reads rows of all sensors with one query per MAX_RANGES ranges. ranges
+    is a list of (sensor_id, start, end) tuples, both ends inclusive.
+    '''
+    if not ranges:
+        return pd.DataFrame()
+    frames = []
+    for batch in batches(ranges):
+        condition = or_(*[and_(table.sensor_id == sensor_id, table.timestamp.between(start, end))
+                          for sensor_id, start, end in batch])
+        frames.append(pd.read_sql(session.query(table).filter(condition).statement, session.bind))
+    data = pd.concat(frames, ignore_index=True)
+    data['timestamp'] = pd.to_datetime(data['timestamp'])
+    data[MEASUREMENTS] = data[MEASUREMENTS].astype(float)
+    return data
+
+
+def rollup(data, buckets, step, expected, locations, fill=True):
+    '''
+    Averages of data (any number of sensors) per (sensor_id, bucket). Flag
+    of a bucket is 1 if less than 75 % of expected rows have flag 0, like
+    count_validity used with resample before. With fill missing buckets
+    between first and last bucket of a sensor are included, with empty
+    values and flag 1. locations maps sensor_id to loc_id. With locations
+    None loc_id of the latest row of each bucket is used, so a sensor that
+    has moved keeps the location its rows were measured at.
+    '''
+    keys = [data['sensor_id'], buckets.rename('timestamp')]
+    means = data[MEASUREMENTS].groupby(keys).mean().round(2)
+    valid = (data[FLAGS] == 0).groupby(keys).sum()
+    flags = (valid / expected * 100 < 75)
+    located = data['loc_id'].groupby(keys).last() if locations is None else None
+    if not fill:
+        result = pd.concat([means, flags.astype(int)], axis=1).reset_index()
+        if located is None:
+            result['loc_id'] = result['sensor_id'].map(locations)
+        else:
+            result['loc_id'] = located.to_numpy()
+        return result
+
+    # Full bucket range of each sensor, built with index arithmetic
+    span = means.reset_index().groupby('sensor_id')['timestamp'].agg(['min', 'max'])
+    step = pd.Timedelta(step)
+    counts = ((span['max'] - span['min']) // step + 1).to_numpy(dtype=int)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    full = pd.MultiIndex.from_arrays([np.repeat(span.index.to_numpy(), counts),
+                                      np.repeat(span['min'].to_numpy(), counts) + offsets * step],
+                                     names=['sensor_id', 'timestamp'])
+
+    result = pd.concat([means.reindex(full), flags.reindex(full, fill_value=True).astype(int)], axis=1)
+    if located is None:
+        result = result.reset_index()
+        result['loc_id'] = result['sensor_id'].map(locations)
+    else:
+        result['loc_id'] = located.reindex(full).groupby(level='sensor_id').ffill().to_numpy()
+        result = result.reset_index()
+    return result
+
+
+def hourly_averages(data, locations, fill=True):
+    return rollup(data, hour_bucket(data['timestamp']), datetime.timedelta(hours=1), 60, locations, fill)
+
+
+def daily_averages(data, locations, fill=True):
+    return rollup(data, day_bucket(data['timestamp']), datetime.timedelta(days=1), 24, locations, fill)
+
+
+# Bucket label expressions of PostgreSQL, same labels as hour_bucket and
+# day_bucket. Timestamps are whole minutes, so subtracting one microsecond
+# moves midnight rows to the previous day like ceil('D') - 1 day.
+SQL_BUCKETS = {'hour': ("date_trunc('hour', s.timestamp) + interval '1 hour'", '1 hour', 60),
+               'day': ("date_trunc('day', s.timestamp - interval '1 microsecond')", '1 day', 24)}
+
+
+def rollup_statement(target, n_ranges, fill=True):
+    '''
+    One INSERT ... SELECT computing averages and validity flags of all
+    pending ranges in the database. With fill empty buckets between first
+    and last bucket of a sensor get empty values and flag 1, like rollup.
+    Existing averages of the same buckets are overwritten. Watermarks of
+    target and dirty buckets of the next rollup are updated in the same
+    statement from the written rows. A sensor may have several ranges (one
+    per run of dirty buckets), so locations are joined from distinct
+    sensors to keep one row per bucket.
+    '''
+    source, bucket = ROLLUPS[target]
+    label, step, expected = SQL_BUCKETS[bucket]
+    values = ', '.join(f'(:sensor_{i}, :loc_{i}, CAST(:start_{i} AS timestamp), CAST(:end_{i} AS timestamp))'
+                       for i in range(n_ranges))
+    means = ', '.join(f'avg(s.{column}) AS {column}' for column in MEASUREMENTS)
+    valid = ', '.join(f'count(*) FILTER (WHERE s.{flag} = 0) AS {flag}' for flag in FLAGS)
+    rounded = ', '.join(f'round(b.{column}::numeric, 2)::float8' for column in MEASUREMENTS)
+    flags = ', '.join(f'CASE WHEN coalesce(b.{flag}, 0) * 100.0 / {expected} < 75 THEN 1 ELSE 0 END'
+                      for flag in FLAGS)
+    columns = ', '.join(['loc_id', 'sensor_id', 'timestamp'] + MEASUREMENTS + FLAGS)
+    updates = ', '.join(f'{column} = EXCLUDED.{column}' for column in MEASUREMENTS + FLAGS)
+    if fill:
+        spans = f'''SELECT sensor_id, generate_series(min(timestamp), max(timestamp), interval '{step}') AS timestamp
+            FROM buckets GROUP BY sensor_id'''
+    else:
+        spans = 'SELECT sensor_id, timestamp FROM buckets'
+    marked = ''
+    for downstream, (downstream_source, downstream_bucket) in ROLLUPS.items():
+        if downstream_source == target:
+            marked += f''',
+        marked AS (
+            INSERT INTO "Dirty_bucket" (sensor_id, target, timestamp)
+            SELECT DISTINCT s.sensor_id, '{TARGETS[downstream]}', {SQL_BUCKETS[downstream_bucket][0]} FROM inserted s
+            ON CONFLICT DO NOTHING)'''
+    return f'''
+        WITH ranges (sensor_id, loc_id, start_time, end_time) AS (VALUES {values}),
+        buckets AS (
+            SELECT s.sensor_id, {label} AS timestamp, {means}, {valid}
+            FROM "{source}" s JOIN ranges r ON s.sensor_id = r.sensor_id
+                AND s.timestamp BETWEEN r.start_time AND r.end_time
+            GROUP BY 1, 2),
+        spans AS (
+            {spans}),
+        sensor_locations AS (
+            SELECT DISTINCT sensor_id, loc_id FROM ranges),
+        inserted AS (
+            INSERT INTO "{target}" ({columns})
+            SELECT r.loc_id, sp.sensor_id, sp.timestamp, {rounded}, {flags}
+            FROM spans sp JOIN sensor_locations r ON sp.sensor_id = r.sensor_id
+                LEFT JOIN buckets b ON sp.sensor_id = b.sensor_id AND sp.timestamp = b.timestamp
+            ON CONFLICT (sensor_id, timestamp) DO UPDATE SET {updates}
+            RETURNING sensor_id, timestamp){marked}
+        INSERT INTO "Ingest_state" (sensor_id, target, timestamp)
+        SELECT sensor_id, :target, max(timestamp) FROM inserted GROUP BY sensor_id
+        ON CONFLICT (sensor_id, target) DO UPDATE
+        SET timestamp = GREATEST("Ingest_state".timestamp, EXCLUDED.timestamp)'''
+
+
+def sql_rollup(session, target, ranges, locations, fill=True):
+    '''
+    Averages ranges [(sensor_id, start, end)] of the source table of target
+    (ROLLUPS) inside the database, so minute rows are not transferred to
+    Python. Callers pass at most MAX_RANGES ranges (batches). Returns
+    number of sensors written.
+    '''
+    if not ranges:
+        return 0
+    params = {'target': TARGETS[target]}
+    for i, (sensor_id, start, end) in enumerate(ranges):
+        params.update({f'sensor_{i}': int(sensor_id), f'loc_{i}': int(locations[sensor_id]),
+                       f'start_{i}': pd.Timestamp(start).to_pydatetime(),
+                       f'end_{i}': pd.Timestamp(end).to_pydatetime()})
+    start = datetime.datetime.now()
+    with session.bind.begin() as connection:
+        sensors = connection.execute(text(rollup_statement(target, len(ranges), fill)), params).rowcount
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    print(f'{target} updated in database for {sensors} sensors in {seconds:.1f} s')
+    return sensors
@@ -10,25 +10,7 @@ import datetime
 import folium
 from folium import Marker
 from folium.features import DivIcon
-
-def read_ilmanetcsv(data_path):
-    def customDateTime(datestr):
-        if '24:00' in datestr:
-            datestr = datestr.replace('24:00', '00:00')
-            return pd.to_datetime(datestr, format="%d.%m.%Y %H:%M") + datetime.timedelta(days=1)
-        else:
-            return pd.to_datetime(datestr, format="%d.%m.%Y %H:%M")
-        
-    data = pd.read_csv(data_path, header=[0,1,2], parse_dates=True)
-    data = data.drop(columns=data.filter(like='22').columns)
-    data.columns = data.columns.droplevel(1)
-    data.iloc[:,0] = data.iloc[:,0].apply(customDateTime)
-    data = data.set_index(data.iloc[:,0])
-    data.index = pd.to_datetime(data.index, format="%d.%m.%Y %H:%M")
-    data = data.apply(pd.to_numeric, errors='coerce')
-    data = data.rename(columns=str.lower).rename(columns={'pm2_5': 'pm25'})
-    data.sort_index(inplace=True)
-    return data
+from stationdata import read_ilmanetcsv
 
 def airQualityTable(data, source='beacon'):
     columns = ['no2', 'pm10', 'pm25', 'co', 'no', 'o3', 'temp', 'rh']
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Cold archive of measurement tables as Parquet files (zstd compressed),
+partitioned by year, month and sensor:
+    {path}/{table}/year=2024/month=5/sensor_id=12/*.parquet
+Raw partitions are moved here by retention (partitions.py). Corrected and
+averaged tables are copied here month by month as a history store, which
+is read instead of the database for old ranges (dbqueries.queryHistory).
+Every piece is written and read with one schema built from the table
+model (table_schema), so a chunk where a column is all NULL does not get
+its own column type. Needs pyarrow.
+
+@author: Taneli Mäkelä
+"""
+import os
+import json
+import datetime
+import pandas as pd
+from sqlalchemy import text, Integer, Float, DateTime
+from database import Base
+
+# History store tables and the file telling how far each is archived
+HISTORY_TABLES = ['Sensor_data', 'Sensor_data_60', 'Sensor_data_1440']
+MANIFEST = '_archived.json'
+
+
+def table_path(path, table):
+    return os.path.join(path, table)
+
+
+def table_schema(table):
+    '''
+    Arrow schema of table from its SQLAlchemy columns, with the year and
+    month partition columns added.
+    '''
+    import pyarrow as pa
+    fields = []
+    for column in Base.metadata.tables[table].columns:
+        if isinstance(column.type, DateTime):
+            fields.append((column.name, pa.timestamp('ns')))
+        elif isinstance(column.type, Integer):
+            fields.append((column.name, pa.int64()))
+        elif isinstance(column.type, Float):
+            fields.append((column.name, pa.float64()))
+        else:
+            fields.append((column.name, pa.string()))
+    return pa.schema(fields + [('year', pa.int32()), ('month', pa.int32())])
+
+
+def open_dataset(path, table):
+    # Dataset of the archive of table read with table_schema, so pieces
+    # written with other inferred types are cast to it
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    schema = table_schema(table)
+    partitioning = ds.partitioning(pa.schema([schema.field(name) for name in ('year', 'month', 'sensor_id')]),
+                                   flavor='hive')
+    return ds.dataset(table_path(path, table), schema=schema, format='parquet', partitioning=partitioning)
+
+
+def to_schema(data, schema):
+    # Arrow table of data with exactly the types of schema. read_sql returns
+    # all NULL columns as object, they are cast here before Arrow sees them.
+    import pyarrow as pa
+    data = data.copy()
+    for field in schema:
+        if pa.types.is_floating(field.type):
+            data[field.name] = data[field.name].astype(float)
+        elif pa.types.is_integer(field.type):
+            data[field.name] = data[field.name].astype('Int64')
+        elif pa.types.is_timestamp(field.type):
+            data[field.name] = pd.to_datetime(data[field.name])
+    return pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+
+
+def export_frame(data, path, table, name):
+    '''
+    Appends rows of data to the archive of table. name must be unique for
+    each exported piece (files named {name}-N.parquet), so reexporting the
+    same piece replaces its files instead of duplicating rows. data must
+    have all columns of table.
+    '''
+    import pyarrow.parquet as pq
+    data = data.copy()
+    timestamps = pd.to_datetime(data['timestamp'])
+    data['year'] = timestamps.dt.year
+    data['month'] = timestamps.dt.month
+    pq.write_to_dataset(to_schema(data, table_schema(table)), table_path(path, table),
+                        partition_cols=['year', 'month', 'sensor_id'], compression='zstd',
+                        basename_template=f'{name}-{{i}}.parquet',
+                        existing_data_behavior='overwrite_or_ignore')
+    return len(data)
+
+
+def count_rows(path, table, year, month):
+    import pyarrow.dataset as ds
+    if not os.path.isdir(table_path(path, table)):
+        return 0
+    return open_dataset(path, table).count_rows(filter=(ds.field('year') == year) & (ds.field('month') == month))
+
+
+def export_query(session, statement, path, table, name, chunksize=500000):
+    '''
+    Exports result of a query to the archive in chunks, so a whole month
+    of minute data does not have to fit in memory. Returns number of rows.
+    '''
+    rows = 0
+    for i, chunk in enumerate(pd.read_sql(statement, session.bind, chunksize=chunksize)):
+        rows += export_frame(chunk, path, table, f'{name}_{i}')
+    return rows
+
+
+def archived_until(path, table):
+    '''
+    Rows of table before this timestamp are in the history store, None if
+    nothing is archived.
+    '''
+    manifest = os.path.join(table_path(path, table), MANIFEST)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest) as f:
+        return pd.Timestamp(json.load(f)['until'])
+
+
+def set_archived_until(path, table, until):
+    manifest = os.path.join(table_path(path, table), MANIFEST)
+    os.makedirs(table_path(path, table), exist_ok=True)
+    with open(manifest + '.tmp', 'w') as f:
+        json.dump({'until': pd.Timestamp(until).isoformat()}, f)
+    os.replace(manifest + '.tmp', manifest)
+
+
+def export_history(session, table, path, keep_months):
+    '''
+    Copies full months of table older than keep_months months to the
+    history store, continuing from the previous export. Rows stay in the
+    database. Returns number of rows exported.
+    '''
+    cutoff = pd.Timestamp(datetime.datetime.now()).to_period('M').to_timestamp() - pd.DateOffset(months=keep_months)
+    first = archived_until(path, table)
+    if first is None:
+        with session.bind.connect() as connection:
+            first = connection.execute(text(f'SELECT min(timestamp) FROM "{table}"')).scalar()
+        if first is None:
+            return 0
+        first = pd.Timestamp(first).to_period('M').to_timestamp()
+
+    rows = 0
+    for month in pd.date_range(first, cutoff, freq='MS', inclusive='left'):
+        upper = month + pd.DateOffset(months=1)
+        statement = (f'SELECT * FROM "{table}" WHERE timestamp >= \'{month:%Y-%m-%d}\' '
+                     f'AND timestamp < \'{upper:%Y-%m-%d}\'')
+        rows += export_query(session, statement, path, table, f'{table}_{month:%Y_%m}')
+        set_archived_until(path, table, upper)
+        print(f'{table} {month:%Y-%m} copied to history store')
+    return rows
+
+
+def read_archive(path, table, date1, date2, columns=None, sensor_ids=None):
+    '''
+    Rows of table between date1 and date2 (both inclusive) from the history
+    store. Only year/month/sensor directories of the range are opened and
+    only given columns (and timestamp, sensor_id, loc_id) are read.
+    '''
+    import pyarrow.dataset as ds
+    if not os.path.isdir(table_path(path, table)):
+        return pd.DataFrame()
+    date1, date2 = pd.Timestamp(date1), pd.Timestamp(date2)
+    months = None
+    for month in pd.date_range(date1.to_period('M').to_timestamp(), date2, freq='MS'):
+        condition = (ds.field('year') == month.year) & (ds.field('month') == month.month)
+        months = condition if months is None else months | condition
+    if months is None:
+        return pd.DataFrame()
+    condition = months & (ds.field('timestamp') >= date1) & (ds.field('timestamp') <= date2)
+    if sensor_ids is not None:
+        condition = condition & ds.field('sensor_id').isin([int(sensor_id) for sensor_id in sensor_ids])
+
+    dataset = open_dataset(path, table)
+    if columns is not None:
+        columns = ['timestamp', 'sensor_id', 'loc_id'] + [c for c in columns if c not in ('timestamp', 'sensor_id', 'loc_id')]
+    data = dataset.to_table(columns=columns, filter=condition).to_pandas()
+    return data.drop(columns=[c for c in ('year', 'month') if c in data.columns])
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of raw Beacon API responses for replay and reprocessing.
+
+@author: Taneli Mäkelä
+"""
+import os
+import gzip
+import time
+import shutil
+import hashlib
+import threading
+import pandas as pd
+
+
+class BeaconCache(object):
+    '''
+    BeaconCache stores raw XML responses of Beacon API gzip compressed under
+    folder path/<MOG serial>/. File name has the requested time window and a
+    hash of the request (endpoint, MOG serial, sensor serial, time window), so
+    the same request always maps to the same file and API key is never stored.
+    Oldest files are evicted when the cache is larger than max_mb or files
+    are older than max_days.
+    '''
+
+    def __init__(self, path, max_mb=None, max_days=None):
+        self.path = path
+        self.max_mb = max_mb
+        self.max_days = max_days
+        os.makedirs(path, exist_ok=True)
+        self.evict()
+
+    def file(self, url, params):
+        request = [requests_host(url)] + [f'{key}={params[key]}' for key in sorted(params) if key != 'k']
+        digest = hashlib.sha256('&'.join(request).encode('utf-8')).hexdigest()[:16]
+        window = f'{compact_time(params["t0"])}_{compact_time(params["t1"])}'
+        return os.path.join(self.path, params['d'], f'{window}_{digest}.xml.gz')
+
+    def load(self, url, params, parse):
+        # Returns parsed cached response or None if request is not cached
+        path = self.file(url, params)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, 'rb') as f:
+            return parse(f)
+
+    def store(self, url, params, raw, parse):
+        '''
+        Streams response body to cache file and parses it from there. File is
+        kept only if it parses, so a broken transfer is never replayed.
+        '''
+        path = self.file(url, params)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with gzip.open(tmp, 'wb') as f:
+                shutil.copyfileobj(raw, f)
+            with gzip.open(tmp, 'rb') as f:
+                result = parse(f)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.replace(tmp, path)
+        return result
+
+    def windows(self, mogserial):
+        # Cached time windows (UTC) of one MOG serial in time order
+        folder = os.path.join(self.path, mogserial)
+        if not os.path.isdir(folder):
+            return []
+        windows = set()
+        for name in os.listdir(folder):
+            if name.endswith('.xml.gz'):
+                t0, t1 = name.split('_')[:2]
+                windows.add((pd.Timestamp(t0), pd.Timestamp(t1)))
+        return sorted(windows)
+
+    def evict(self):
+        files = []
+        for folder, _, names in os.walk(self.path):
+            for name in names:
+                path = os.path.join(folder, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, stat.st_size, path))
+        files.sort()
+
+        removed = 0
+        if self.max_days is not None:
+            limit = time.time() - self.max_days * 86400
+            while files and files[0][0] < limit:
+                os.remove(files.pop(0)[2])
+                removed += 1
+        if self.max_mb is not None:
+            size = sum(file[1] for file in files)
+            while files and size > self.max_mb * 1024 * 1024:
+                mtime, file_size, path = files.pop(0)
+                os.remove(path)
+                size -= file_size
+                removed += 1
+        if removed:
+            print(f'{removed} files evicted from Beacon cache')
+
+
+def requests_host(url):
+    return url.split('//')[-1].split('/')[0]
+
+
+def compact_time(timestamp):
+    # 2022-01-01T00:00:00 -> 20220101T000000, usable in file names on Windows
+    return timestamp.replace('-', '').replace(':', '')
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP client shared by AQTParser objects for Vaisala Beacon API calls.
+
+@author: Taneli Mäkelä
+"""
+import os
+import json
+import time
+import datetime
+import threading
+import requests
+import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+
+
+class BeaconError(Exception):
+    '''Raised when no valid response was received from Beacon APIs.'''
+
+
+class BeaconClient(object):
+    '''
+    BeaconClient keeps a pool of keep-alive connections to Beacon API hosts
+    and is shared by all AQTParser objects of one run. Requests have connect
+    and read timeouts and failed requests are retried with exponential
+    backoff. Each host has a circuit breaker which stops calling the host for
+    a while after consecutive failures. Client also remembers MOG serials for
+    which legacy API returned no data while the newer API did, so the legacy
+    call can be skipped for them. Optional deadline stops all requests when
+    the time budget of the run is used. With a BeaconCache every response is
+    also stored on disk and replay requests are served from the cache only.
+    base_url redirects all requests to another server with the same paths,
+    e.g. the local Beacon stand-in of beaconstub.py.
+    '''
+
+    def __init__(self, pool_size=10, connect_timeout=5, read_timeout=120, retries=3, backoff=2,
+                 failure_threshold=5, cooldown=300, deadline=None, state_file=None, cache=None,
+                 base_url=None):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.deadline = deadline
+        self.state_file = state_file
+        self.cache = cache
+        self.base_url = base_url
+
+        self.lock = threading.Lock()
+        self.failures = {}          # host -> number of consecutive failures
+        self.open_until = {}        # host -> time when host can be called again
+        self.legacy_empty = set()   # MOG serials skipped on legacy API
+        if state_file and os.path.exists(state_file):
+            with open(state_file, 'r') as f:
+                self.legacy_empty = set(json.load(f))
+
+    def time_left(self):
+        if self.deadline is None:
+            return None
+        return (self.deadline - datetime.datetime.now()).total_seconds()
+
+    def expired(self):
+        time_left = self.time_left()
+        return time_left is not None and time_left <= 0
+
+    def skip_legacy(self, mogserial):
+        return mogserial in self.legacy_empty
+
+    def mark_legacy_empty(self, mogserial):
+        with self.lock:
+            self.legacy_empty.add(mogserial)
+            if self.state_file:
+                with open(self.state_file, 'w') as f:
+                    json.dump(sorted(self.legacy_empty), f)
+
+    def _host(self, url):
+        return requests.utils.urlparse(url).netloc
+
+    def _circuit_open(self, host):
+        with self.lock:
+            return time.monotonic() < self.open_until.get(host, 0)
+
+    def _record(self, host, success):
+        with self.lock:
+            if success:
+                self.failures[host] = 0
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.failure_threshold:
+                self.open_until[host] = time.monotonic() + self.cooldown
+                self.failures[host] = 0
+                print(datetime.datetime.now(), f'Too many failed requests to {host}, pausing calls for {self.cooldown} s')
+
+    def fetch(self, url, params, parse, replay=False):
+        '''
+        Requests url and passes the streamed response body to parse function.
+        Whole transfer and parse is retried on connection errors, timeouts,
+        broken XML and 429/5xx responses. Returns result of parse or None if
+        no valid response was received. In replay mode response is read from
+        cache without network access.
+        '''
+        if replay:
+            if self.cache is None:
+                raise ValueError('Replay requires BeaconClient with cache')
+            return self.cache.load(url, params, parse)
+        
+        cache_url = url
+        if self.base_url:
+            url = self.base_url.rstrip('/') + '/' + url.split('//', 1)[-1].split('/', 1)[-1]
+        host = self._host(url)
+        for attempt in range(self.retries + 1):
+            if self.expired():
+                print(datetime.datetime.now(), params.get('d'), 'Run deadline reached, request skipped')
+                return None
+            if self._circuit_open(host):
+                print(datetime.datetime.now(), params.get('d'), f'Requests to {host} paused, request skipped')
+                return None
+
+            read_timeout = self.read_timeout
+            time_left = self.time_left()
+            if time_left is not None:
+                read_timeout = max(1, min(read_timeout, time_left))
+
+            retry = False
+            try:
+                with self.session.get(url, params=params, stream=True,
+                                      timeout=(self.connect_timeout, read_timeout)) as r:
+                    if r.status_code == 200:
+                        r.raw.decode_content = True
+                        if self.cache is not None:
+                            result = self.cache.store(cache_url, params, r.raw, parse)
+                        else:
+                            result = parse(r.raw)
+                        self._record(host, True)
+                        return result
+                    print(datetime.datetime.now(), params.get('d'), 'Error! Response status code:', r.status_code)
+                    retry = r.status_code == 429 or r.status_code >= 500
+            except (requests.exceptions.RequestException, HTTPError, ET.ParseError) as e:
+                print(datetime.datetime.now(), params.get('d'), e)
+                retry = True
+
+            # Other 4xx answers are about the request, not the host, so they
+            # neither count as failures nor reset the failure count
+            if retry:
+                self._record(host, False)
+            if not retry or attempt == self.retries:
+                return None
+
+            wait = self.backoff * 2 ** attempt
+            time_left = self.time_left()
+            if time_left is not None:
+                wait = min(wait, max(0, time_left))
+            time.sleep(wait)
+        return None
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for Vaisala Beacon APIs (beacon.vaisala.com/api/ and
+wxbeacon.vaisala.com/api/xml) for load testing the ingest without the live
+service. Serves synthetic AQT530 data for configurable number of sensors.
+
+Run: python beaconstub.py --port 8000 --sensors 50 --latency 0.5
+and point BeaconClient(base_url='http://127.0.0.1:8000') to it.
+
+@author: Taneli Mäkelä
+"""
+import time
+import random
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Measurement types of AQT530 with typical level and variation. Legacy API
+# sends gases in ppm and the newer API in ppb together with PM1.
+LEGACY_TYPES = {'NO2': (0.015, 0.01), 'NO': (0.01, 0.01), 'CO': (0.3, 0.1), 'O3': (0.02, 0.01),
+                'PM10': (15, 10), 'PM2.5': (7, 5), 'Air Temp.': (5, 8), 'Air Hum.': (70, 15),
+                'Air Pres.': (1010, 10)}
+WX_TYPES = {'NO2': (15, 10), 'NO': (10, 10), 'CO': (300, 100), 'O3': (20, 10),
+            'PM10': (15, 10), 'PM2.5': (7, 5), 'PM1': (4, 3), 'Air temperature': (5, 8),
+            'Relative humidity': (70, 15), 'Air pressure': (1010, 10)}
+
+
+def sensor_serials(sensors):
+    # MOG and AQT serials of the synthetic sensors. Every other sensor sends
+    # data only to the newer API, like the real network.
+    return [(f'MOG{i:04d}', f'T{i:07d}', i % 2 == 0) for i in range(sensors)]
+
+
+def generate_xml(mogserial, t0, t1, types, limit=None):
+    '''
+    Synthetic one minute data of one sensor between t0 and t1 as Beacon XML.
+    Values depend only on MOG serial and timestamp, so repeated requests of
+    the same window return the same data.
+    '''
+    t1 = min(pd.Timestamp(t1), pd.Timestamp.utcnow().tz_localize(None))   # no data from the future
+    minutes = pd.date_range(pd.Timestamp(t0).ceil('T'), t1, freq='T', inclusive='left')
+    if limit is not None:
+        minutes = minutes[:max(0, int(limit) // len(types))]
+    seed = sum(ord(c) for c in mogserial)
+    phase = (minutes.asi8 // 60_000_000_000 % 1440) / 1440 * 2 * np.pi
+    stamps = minutes.strftime('%Y-%m-%dT%H:%M:%S')
+
+    parts = [f'<data><device id="{mogserial}">']
+    for k, (meastype, (level, variation)) in enumerate(types.items()):
+        noise = np.random.default_rng(seed + k).normal(0, variation / 4, len(minutes))
+        values = np.round(level + variation * np.sin(phase + seed) + noise, 4)
+        parts.extend(f'<meas><timestamp>{stamp}</timestamp><type>{meastype}</type><value>{value}</value></meas>'
+                     for stamp, value in zip(stamps, values))
+    parts.append('</device></data>')
+    return ''.join(parts).encode('utf-8')
+
+
+class BeaconStubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        settings = self.server.settings
+        url = urlparse(self.path)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        time.sleep(settings['latency'] * random.uniform(0.5, 1.5))
+
+        if random.random() < settings['error_rate']:
+            self.send_error(settings['error_code'])
+            return
+        if url.path.rstrip('/') == '/api':
+            types = LEGACY_TYPES
+        elif url.path.rstrip('/') == '/api/xml':
+            types = WX_TYPES
+        else:
+            self.send_error(404)
+            return
+
+        serials = self.server.serials
+        mogserial = query.get('d')
+        if mogserial not in serials:
+            self.send_error(404)
+            return
+        legacy = serials[mogserial]
+        if random.random() < settings['empty_rate'] or legacy != (types is LEGACY_TYPES):
+            body = b'<data></data>'
+        else:
+            body = generate_xml(mogserial, query['t0'], query['t1'], types, query.get('c'))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if settings['slow_body']:
+            # Body is sent in chunks at slow_body bytes per second
+            chunk = max(1, int(settings['slow_body'] / 10))
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i:i + chunk])
+                time.sleep(0.1)
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(port=8000, sensors=10, latency=0, error_rate=0, error_code=503, empty_rate=0, slow_body=None):
+    '''
+    Starts stand-in server in a background thread. Returns server and list
+    of (MOG serial, sensor serial, legacy) tuples of the synthetic sensors.
+    Call server.shutdown() to stop.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', port), BeaconStubHandler)
+    serials = sensor_serials(sensors)
+    server.serials = {mogserial: legacy for mogserial, _, legacy in serials}
+    server.settings = {'latency': latency, 'error_rate': error_rate, 'error_code': error_code,
+                       'empty_rate': empty_rate, 'slow_body': slow_body}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, serials
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Beacon API stand-in')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--sensors', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0, help='mean response latency in seconds')
+    parser.add_argument('--error-rate', type=float, default=0, help='share of requests answered with error')
+    parser.add_argument('--error-code', type=int, default=503)
+    parser.add_argument('--empty-rate', type=float, default=0, help='share of requests answered with no data')
+    parser.add_argument('--slow-body', type=float, default=None, help='send body at this many bytes per second')
+    args = parser.parse_args()
+
+    server, serials = start_server(args.port, args.sensors, args.latency, args.error_rate,
+                                   args.error_code, args.empty_rate, args.slow_body)
+    print(f'Beacon stand-in with {args.sensors} sensors at http://127.0.0.1:{args.port}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
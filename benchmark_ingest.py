@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Ingest benchmark against the local Beacon stand-in (beaconstub.py). Drives
+the same fetch, parse and edit path as dbqueries.updateDatabase for growing
+number of sensors and reports throughput, latency percentiles and peak memory.
+Database writes are not included, so no database is needed.
+
+Run: python benchmark_ingest.py --sensors 1 10 50 --workers 8 --days 1
+
+@author: Taneli Mäkelä
+"""
+import time
+import argparse
+import datetime
+import tracemalloc
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import beaconstub
+import dbqueries
+from beaconclient import BeaconClient
+
+
+def run_ingest(serials, base_url, starttime, max_workers):
+    sensors = pd.DataFrame([{'id': i, 'name': f'STUB{i:03d}', 'loc_id': i, 'mog': mogserial,
+                             'apikey': 'stub', 'serial': serial}
+                            for i, (mogserial, serial, _) in enumerate(serials)])
+    client = BeaconClient(pool_size=max_workers, retries=1, backoff=0.1, base_url=base_url)
+
+    def timed_fetch(row):
+        start = time.perf_counter()
+        try:
+            data = dbqueries.fetch_sensor_data(row, starttime, client)
+        except Exception as e:
+            print(row.name, e)
+            data = pd.DataFrame()
+        return len(data), time.perf_counter() - start
+
+    rows = 0
+    latencies = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(timed_fetch, row) for row in sensors.itertuples()]
+        for future in as_completed(futures):
+            n, latency = future.result()
+            rows += n
+            latencies.append(latency)
+    return rows, latencies
+
+
+def benchmark(sensor_counts, max_workers, days, port, **stub_settings):
+    results = []
+    starttime = pd.Timestamp(datetime.datetime.now()).floor('T') - datetime.timedelta(days=days)
+    for count in sensor_counts:
+        server, serials = beaconstub.start_server(port, count, **stub_settings)
+        try:
+            tracemalloc.start()
+            start = time.perf_counter()
+            rows, latencies = run_ingest(serials, f'http://127.0.0.1:{port}', starttime, max_workers)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        results.append({'sensors': count, 'rows': rows, 'seconds': round(seconds, 2),
+                        'rows/s': round(rows / seconds), 'sensors/s': round(count / seconds, 2),
+                        'p50 s': round(np.percentile(latencies, 50), 2),
+                        'p95 s': round(np.percentile(latencies, 95), 2),
+                        'p99 s': round(np.percentile(latencies, 99), 2),
+                        'peak MB': round(peak / 1024 / 1024, 1)})
+    return pd.DataFrame(results).set_index('sensors')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Beacon ingest against local stand-in')
+    parser.add_argument('--sensors', type=int, nargs='+', default=[1, 5, 10, 25])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--days', type=float, default=1, help='length of fetched window')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--empty-rate', type=float, default=0)
+    parser.add_argument('--slow-body', type=float, default=None)
+    args = parser.parse_args()
+
+    print(benchmark(args.sensors, args.workers, args.days, args.port, latency=args.latency,
+                    error_rate=args.error_rate, empty_rate=args.empty_rate,
+                    slow_body=args.slow_body).to_string())
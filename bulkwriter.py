@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk writes of measurement dataframes to PostgreSQL with COPY.
+
+@author: Taneli Mäkelä
+"""
+import io
+import datetime
+import pandas as pd
+from sqlalchemy import Integer
+from database import Base
+from watermarks import update_watermarks
+from dirtybuckets import create_dirty_table, mark_dirty
+
+# Columns of the unique constraint of measurement tables
+CONFLICT_COLUMNS = ['sensor_id', 'timestamp']
+
+
+def frame_to_csv(table, data):
+    # Integer columns with missing values would be written as floats (1.0)
+    # which COPY does not accept for integer columns
+    columns = Base.metadata.tables[table].columns
+    data = data.copy()
+    for column in data.columns:
+        if column in columns and isinstance(columns[column].type, Integer):
+            data[column] = data[column].astype('Int64')
+
+    buffer = io.StringIO()
+    data.to_csv(buffer, index=False, header=False, na_rep='', date_format='%Y-%m-%d %H:%M:%S')
+    buffer.seek(0)
+    return buffer
+
+
+def upsert_statement(table, columns, on_conflict):
+    # Rows are first copied to a temporary table and then moved to the target
+    # table. Existing rows of the same sensor and timestamp are kept
+    # (on_conflict='ignore') or overwritten (on_conflict='update').
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    if on_conflict == 'ignore':
+        action = 'DO NOTHING'
+    elif on_conflict == 'update':
+        updates = ', '.join(f'"{column}" = EXCLUDED."{column}"' for column in columns if column not in CONFLICT_COLUMNS)
+        action = f'DO UPDATE SET {updates}'
+    else:
+        raise ValueError(f'Unknown on_conflict mode {on_conflict}')
+    return (f'INSERT INTO "{table}" ({column_list}) SELECT {column_list} FROM "tmp_{table}" '
+            f'ON CONFLICT ({", ".join(CONFLICT_COLUMNS)}) {action}')
+
+
+def copy_frames(session, tables, on_conflict=None):
+    '''
+    Writes dataframes to database tables with COPY FROM STDIN (CSV format).
+    tables is a dictionary {table name: list of dataframes}. All frames of a
+    table are concatenated to a single COPY and all tables are written in one
+    transaction, so either everything or nothing is stored. Ingest watermarks
+    of the written sensors are moved in the same transaction. With on_conflict
+    'ignore' or 'update' rows go through ON CONFLICT (sensor_id, timestamp)
+    upsert, so rerunning a write does not duplicate rows. Buckets of hourly
+    and daily averages that got rows are marked dirty in the same
+    transaction. Returns number of rows written.
+    '''
+    start = datetime.datetime.now()
+    rows = 0
+    create_dirty_table(session, tables)
+    connection = session.bind.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            for table, frames in tables.items():
+                frames = [frame for frame in frames if not frame.empty]
+                if not frames:
+                    continue
+                data = pd.concat(frames, ignore_index=True)
+                columns = ', '.join(f'"{column}"' for column in data.columns)
+                if on_conflict is None:
+                    cursor.copy_expert(f'COPY "{table}" ({columns}) FROM STDIN WITH (FORMAT csv)',
+                                       frame_to_csv(table, data))
+                else:
+                    # One INSERT can not touch the same row twice
+                    data = data.drop_duplicates(subset=CONFLICT_COLUMNS, keep='last')
+                    cursor.execute(f'CREATE TEMP TABLE "tmp_{table}" ON COMMIT DROP AS '
+                                   f'SELECT {columns} FROM "{table}" WITH NO DATA')
+                    cursor.copy_expert(f'COPY "tmp_{table}" ({columns}) FROM STDIN WITH (FORMAT csv)',
+                                       frame_to_csv(table, data))
+                    cursor.execute(upsert_statement(table, data.columns, on_conflict))
+                update_watermarks(cursor, table, data)
+                mark_dirty(cursor, table, data)
+                rows += len(data)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    print(f'{rows} rows written to {", ".join(tables)} in {seconds:.1f} s ({rows / max(seconds, 1e-3):.0f} rows/s)')
+    return rows
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Calibration of sensor data with time-versioned slope and bias coefficients.
+
+@author: Taneli Mäkelä
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import inspect
+from database import Calibration
+
+COMPONENTS = ['no2', 'no', 'co', 'o3', 'pm10', 'pm25', 'pm1']
+
+# Version keys combine sensor and minutes since 1970 into one int64:
+# sensor_code * 2**40 + minutes
+MINUTE_BITS = 40
+
+
+class CalibrationMatrix(object):
+    '''
+    CalibrationMatrix holds *_slope and *_bias coefficients of all sensors as
+    dense (version x component) arrays. Each sensor has a version from Sensor
+    table valid from the beginning and one version for every row of
+    Calibration table valid from its valid_from. Frames with any number of
+    sensors are corrected with one index lookup and broadcasted multiply, so
+    reprocessing history uses the coefficients valid at each timestamp.
+    '''
+
+    def __init__(self, sensors, history=None, components=COMPONENTS):
+        self.components = components
+        versions = sensors[['id'] + [f'{c}_slope' for c in components] + [f'{c}_bias' for c in components]]
+        versions = versions.rename(columns={'id': 'sensor_id'}).assign(valid_from=pd.Timestamp(0))
+        if history is not None and not history.empty:
+            versions = pd.concat([versions, history[versions.columns]], ignore_index=True)
+
+        self.sensor_ids = np.sort(versions['sensor_id'].unique())
+        keys = self.keys(versions['sensor_id'], versions['valid_from'])
+        order = np.argsort(keys, kind='stable')
+        self.version_keys = keys[order]
+        self.slopes = versions[[f'{c}_slope' for c in components]].to_numpy(dtype=float)[order]
+        self.biases = versions[[f'{c}_bias' for c in components]].to_numpy(dtype=float)[order]
+
+    def keys(self, sensor_ids, timestamps):
+        sensor_codes = np.searchsorted(self.sensor_ids, np.asarray(sensor_ids))
+        minutes = pd.to_datetime(timestamps).values.astype('datetime64[m]').astype(np.int64)
+        return (sensor_codes.astype(np.int64) << MINUTE_BITS) + minutes
+
+    def correct(self, data):
+        '''
+        Returns copy of data with components corrected as value * slope + bias,
+        using coefficients of each row's sensor valid at the row's timestamp.
+        Rows of unknown sensors are left unchanged.
+        '''
+        df = data.copy()
+        components = [c for c in self.components if c in df.columns]
+        if df.empty or not components:
+            return df
+
+        known = np.isin(df['sensor_id'].to_numpy(), self.sensor_ids)
+        version = np.searchsorted(self.version_keys, self.keys(df['sensor_id'], df['timestamp']), side='right') - 1
+        columns = [self.components.index(c) for c in components]
+        slopes = np.where(known[:, None], self.slopes[version][:, columns], 1)
+        biases = np.where(known[:, None], self.biases[version][:, columns], 0)
+        df[components] = df[components].to_numpy(dtype=float) * slopes + biases
+        return df
+
+
+def load_calibration(session, sensors, components=COMPONENTS):
+    # Calibration history is optional; without it Sensor table coefficients
+    # are used for all timestamps
+    history = None
+    if inspect(session.bind).has_table(Calibration.__tablename__):
+        history = pd.read_sql(session.query(Calibration).statement, session.bind)
+    return CalibrationMatrix(sensors, history, components)
@@ -4,13 +4,28 @@ Created on Tue May  4 14:11:23 2021
 
 @author: Taneli Mäkelä
 """
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, Text, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, Float, Text, DateTime, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 # Base.metadata.create_all(engine)
 
+
+def measurement_table_args(table, brin=False, partitioned=False):
+    # Each sensor has one row per timestamp. The unique constraint also gives
+    # the (sensor_id, timestamp) index used by range queries and ON CONFLICT
+    # upserts. BRIN index keeps time range scans cheap on big append-only tables.
+    # Partitioned tables are split to monthly partitions on timestamp
+    # (partitions.py), so their primary key must include timestamp too.
+    args = [UniqueConstraint('sensor_id', 'timestamp', name=f'{table}_sensor_id_timestamp_key')]
+    if brin:
+        args.append(Index(f'{table}_timestamp_brin', 'timestamp', postgresql_using='brin'))
+    if partitioned:
+        args.append({'postgresql_partition_by': 'RANGE (timestamp)'})
+    return tuple(args)
+
+
 class Location(Base):
     __tablename__ = 'Location'
 
@@ -58,9 +73,10 @@ class Sensor(Base):
 
 class Sensor_data_raw(Base):
     __tablename__ = 'Sensor_data_raw'
+    __table_args__ = measurement_table_args('Sensor_data_raw', brin=True, partitioned=True)
 
-    id = Column(Integer, primary_key=True)
-    timestamp = Column(DateTime, nullable=False)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    timestamp = Column(DateTime, primary_key=True)
     no2 = Column(Float)
     no = Column(Float)
     co = Column(Float)
@@ -77,11 +93,12 @@ class Sensor_data_raw(Base):
     
 class Sensor_data(Base):
     __tablename__ = 'Sensor_data'
+    __table_args__ = measurement_table_args('Sensor_data', brin=True, partitioned=True)
 
-    id = Column(Integer, primary_key=True)
+    id = Column(Integer, primary_key=True, autoincrement=True)
     loc_id = Column(Integer, ForeignKey('Location.id'), nullable=False)
     sensor_id = Column(Integer, ForeignKey('Sensor.id'), nullable=False)
-    timestamp = Column(DateTime, nullable=False)
+    timestamp = Column(DateTime, primary_key=True)
     no2 = Column(Float)
     no = Column(Float)
     co = Column(Float)
@@ -105,6 +122,7 @@ class Sensor_data(Base):
     
 class Sensor_data_60(Base):
     __tablename__ = 'Sensor_data_60'
+    __table_args__ = measurement_table_args('Sensor_data_60')
 
     id = Column(Integer, primary_key=True)
     loc_id = Column(Integer, ForeignKey('Location.id'), nullable=False)
@@ -133,6 +151,7 @@ class Sensor_data_60(Base):
     
 class Sensor_data_1440(Base):
     __tablename__ = 'Sensor_data_1440'
+    __table_args__ = measurement_table_args('Sensor_data_1440')
 
     id = Column(Integer, primary_key=True)
     loc_id = Column(Integer, ForeignKey('Location.id'), nullable=False)
@@ -162,6 +181,7 @@ class Sensor_data_1440(Base):
     
 class Wxt_data(Base):
     __tablename__ = 'Wxt_data'
+    __table_args__ = measurement_table_args('Wxt_data', brin=True)
 
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, nullable=False)
@@ -181,6 +201,7 @@ class Wxt_data(Base):
     
 class Wxt_data_60(Base):
     __tablename__ = 'Wxt_data_60'
+    __table_args__ = measurement_table_args('Wxt_data_60')
 
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, nullable=False)
@@ -200,6 +221,7 @@ class Wxt_data_60(Base):
     
 class Wxt_data_1440(Base):
     __tablename__ = 'Wxt_data_1440'
+    __table_args__ = measurement_table_args('Wxt_data_1440')
 
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime, nullable=False)
@@ -217,6 +239,59 @@ class Wxt_data_1440(Base):
     ws_flag = Column(Integer, default=0)
     wd_flag = Column(Integer, default=0)
     
+
+class Calibration(Base):
+    __tablename__ = 'Calibration'
+    __table_args__ = (UniqueConstraint('sensor_id', 'valid_from', name='Calibration_sensor_id_valid_from_key'),)
+
+    # Coefficients valid from valid_from until the next row of the same sensor.
+    # Before the first row coefficients of Sensor table are used.
+    id = Column(Integer, primary_key=True)
+    sensor_id = Column(Integer, ForeignKey('Sensor.id'), nullable=False)
+    valid_from = Column(DateTime, nullable=False)
+    no2_slope = Column(Float, default=1)
+    no_slope = Column(Float, default=1)
+    co_slope = Column(Float, default=1)
+    o3_slope = Column(Float, default=1)
+    pm10_slope = Column(Float, default=1)
+    pm25_slope = Column(Float, default=1)
+    pm1_slope = Column(Float, default=1)
+    no2_bias = Column(Float, default=0)
+    no_bias = Column(Float, default=0)
+    co_bias = Column(Float, default=0)
+    o3_bias = Column(Float, default=0)
+    pm10_bias = Column(Float, default=0)
+    pm25_bias = Column(Float, default=0)
+    pm1_bias = Column(Float, default=0)
+
+
+class Ingest_state(Base):
+    __tablename__ = 'Ingest_state'
+
+    sensor_id = Column(Integer, ForeignKey('Sensor.id'), primary_key=True)
+    target = Column(String(20), primary_key=True)   # 'raw', '60' or '1440'
+    timestamp = Column(DateTime, nullable=False)    # latest timestamp stored to target table
+
+
+class Dirty_bucket(Base):
+    __tablename__ = 'Dirty_bucket'
+
+    sensor_id = Column(Integer, ForeignKey('Sensor.id'), primary_key=True)
+    target = Column(String(20), primary_key=True)   # '60' or '1440'
+    timestamp = Column(DateTime, primary_key=True)  # label of the average that must be recomputed
+
+
+class Reference_data(Base):
+    __tablename__ = 'Reference_data'
+
+    # Hourly values of reference stations (ilmanet CSV), one row per station,
+    # component and hour. Timestamp is the end of the hour like in
+    # Sensor_data_60, so the tables join on timestamp.
+    station_id = Column(Integer, primary_key=True)   # Siteno of the station
+    component = Column(String(20), primary_key=True)
+    timestamp = Column(DateTime, primary_key=True)
+    value = Column(Float)
+
     
 #----------------------------
 # Luodaan tietokanta ja populoidaan sijainti ja sensoritaulukko
@@ -240,6 +315,56 @@ def create_database(locations, sensors, ini):
     locations.to_sql('Location', session.bind, index=False, if_exists=('append'))
     sensors.to_sql('Sensor', session.bind, index=False, if_exists=('append'))
 
+    # Monthly partitions of measurement tables from the first measurement on
+    from partitions import ensure_partitions
+    ensure_partitions(session, start=sensors['date_started'].min())
+
+
+def migrate_database(ini, partition=False):
+    '''
+    Adds missing tables, unique constraints and indexes to an existing
+    database. Duplicate rows (same sensor and timestamp) are removed before
+    adding unique constraint, keeping the row with lowest id. With partition
+    existing Sensor_data_raw and Sensor_data tables are converted to monthly
+    partitions, which copies all their rows. Ingest watermarks are rebuilt
+    from the migrated tables.
+    '''
+    from sqlalchemy import create_engine, inspect, text
+    from sqlalchemy.schema import AddConstraint, CreateIndex
+    path = f'postgresql://{ini.loc["user"][0]}:{ini.loc["pw"][0]}@{ini.loc["host"][0]}/{ini.loc["database"][0]}'
+    engine = create_engine(path)
+    Base.metadata.create_all(engine)
+    
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = ({constraint['name'] for constraint in inspector.get_unique_constraints(table.name)} |
+                    {index['name'] for index in inspector.get_indexes(table.name)})
+        with engine.begin() as connection:
+            for constraint in table.constraints:
+                if not isinstance(constraint, UniqueConstraint) or not constraint.name or constraint.name in existing:
+                    continue
+                same = ' AND '.join(f'a."{column.name}" = b."{column.name}"' for column in constraint.columns)
+                deleted = connection.execute(text(f'''DELETE FROM "{table.name}" a USING "{table.name}" b
+                                                     WHERE {same} AND a.id > b.id'''))
+                print(f'{deleted.rowcount} duplicate rows deleted from {table.name}')
+                connection.execute(AddConstraint(constraint))
+                print(f'Added {constraint.name}')
+            for index in table.indexes:
+                if index.name not in existing:
+                    connection.execute(CreateIndex(index))
+                    print(f'Added {index.name}')
+
+    if partition:
+        from partitions import PARTITIONED, partition_existing
+        for table in PARTITIONED:
+            partition_existing(engine, table)
+
+    # create_all made an empty Ingest_state, which would restart every
+    # sensor from date_started
+    from sqlalchemy.orm import sessionmaker
+    from watermarks import rebuild_watermarks
+    rebuild_watermarks(sessionmaker(bind=engine)())
+
 
 # import pandas as pd
 # locations = pd.read_csv(r"C:\Users\Ilmanlaatu\Desktop\Sensor_network_v2\Location.csv", header=0, sep=';')
@@ -7,13 +7,89 @@ Created on Tue May  4 14:14:14 2021
 import pandas as pd
 import numpy as np
 import datetime
-import requests
+import itertools
+import collections
 import xml.etree.ElementTree as ET
+import qualitycontrol
+import aggregation
+import archive
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from beaconclient import BeaconClient, BeaconError
+from bulkwriter import copy_frames
+from calibration import CalibrationMatrix, load_calibration
+from watermarks import load_watermarks, rebuild_watermarks, resume_time
+from dirtybuckets import load_dirty, dirty_ranges, clear_dirty, clear_dirty_ranges
 from database import Sensor_data, Sensor_data_raw, Sensor, Location, Sensor_data_60, Sensor_data_1440
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select, tuple_
 from sqlalchemy.orm import sessionmaker
 
 
+# Beacon measurement types and the column names used in database. Types that
+# are not listed keep their Beacon name.
+BEACON_MEASTYPES = {'Air Hum.': 'rh', 'Air Pres.':'pres', 'Air Temp.': 'temp',
+                    'CO': 'co', 'NO': 'no', 'NO2': 'no2', 'O3': 'o3', 'PM10': 'pm10', 
+                    'PM2.5': 'pm25','PM1': 'pm1', 'Wind Dir.': 'wd', 'Wind Speed': 'ws', 'Rain': 'rain',
+                    'Air temperature':'temp', 'Air pressure': 'pres', 'Relative humidity': 'rh'}
+
+# Maximum number of measurements in one Beacon API response and the number of
+# measurement types AQT sends per minute (10 with PM1). Windows are sized so
+# that a full window fits in one response (90720 / 9 minutes = 7 days). The
+# default window assumes PM1, so it fits for every sensor.
+BEACON_ROW_CAP = 90720
+BEACON_TYPES_PER_MINUTE = 9
+BEACON_TYPES_PER_MINUTE_PM1 = 10
+
+
+def beacon_window(types_per_minute=BEACON_TYPES_PER_MINUTE_PM1):
+    return datetime.timedelta(minutes=BEACON_ROW_CAP // types_per_minute)
+
+
+BEACON_WINDOW = beacon_window()
+
+# Conversion factors from ppm to ug/m3. Sensors reporting PM1 send gases in ppb.
+UNIT_FACTORS = {'co': 1160, 'no': 1247, 'no2': 1912, 'o3': 1996}
+
+# Source tables of hourly and daily averages
+ROLLUP_SOURCES = {'Sensor_data': Sensor_data, 'Sensor_data_60': Sensor_data_60}
+
+
+def reshape_beacon_data(row_codes, column_codes, values, timestamps, columns):
+    '''
+    Reshapes long Beacon data to a wide dataframe. Timestamps and column names
+    are given once and each value refers to them with integer codes, so values
+    are scattered to a dense timestamp x column array by index arithmetic.
+    First valid value is kept for duplicate timestamp and column pairs.
+    '''
+    valid = ~np.isnan(values)
+    keys = row_codes[valid] * len(columns) + column_codes[valid]
+    keys, first = np.unique(keys, return_index=True)
+    
+    dense = np.full(len(timestamps) * len(columns), np.nan)
+    dense[keys] = values[valid][first]
+    
+    data = pd.DataFrame(dense.reshape(len(timestamps), len(columns)),
+                        index=pd.Index(timestamps, name='timestamp'), columns=columns)
+    return data.sort_index()
+
+
+def convert_beacon_units(data):
+    '''
+    Converts gases from ppm (or ppb) to ug/m3 with a single vector multiply and
+    adds empty pm1 column for sensors that do not measure it.
+    '''
+    if data.empty:
+        return data
+    
+    divisor = 1000 if 'pm1' in data.columns else 1
+    factors = np.array([UNIT_FACTORS[column] / divisor if column in UNIT_FACTORS else 1 
+                        for column in data.columns])
+    data = pd.DataFrame(data.to_numpy(dtype=float) * factors,
+                        index=data.index, columns=data.columns).round(2)
+    if not 'pm1' in data.columns:
+        data['pm1'] = np.nan
+    return data
+
+
 class AQTParser(object):
     '''
     AQTParser object is assigned to single Vaisala AQT-sensor and is used to 
@@ -23,99 +99,128 @@ class AQTParser(object):
     table self.name.
     '''
     
-    def __init__(self, loc_id, mogserial, apiKey, sensor_id, sensor_serial):
+    def __init__(self, loc_id, mogserial, apiKey, sensor_id, sensor_serial, client=None,
+                 types_per_minute=BEACON_TYPES_PER_MINUTE_PM1):
         self.loc_id = loc_id               # Table name for the database
         self.mogserial = mogserial
         self.apiKey = apiKey
         self.sensor_id = sensor_id
         self.sensor_serial = sensor_serial
+        self.client = client if client is not None else BeaconClient()
+        self.window = beacon_window(types_per_minute)
         
-    def loop_xml_file(self, root):
-        childNodeList = {'timestamp':[],'meastype':[],'value':[]}
-        for meas in root.iter("meas"):
-            timestamp = meas.findtext("timestamp")
-            meastype = meas.findtext("type")
-            value = meas.findtext("value")
+    def stream_xml_file(self, source, capacity=1024):
+        '''
+        Parses Beacon XML incrementally from file-like source (e.g. raw HTTP
+        response). Every <meas> element is dropped from the tree right after
+        it is read. Timestamps and measurement types are mapped to integer
+        codes once and values are written to preallocated numeric arrays,
+        so memory use follows the number of measurements instead of the size
+        of the XML document. Returns wide dataframe (timestamp x component).
+        '''
+        rows = {}
+        columns = {}
+        size = max(1, capacity)
+        row_codes = np.empty(size, dtype=np.int64)
+        column_codes = np.empty(size, dtype=np.int64)
+        values = np.empty(size)
+        n = 0
         
-            childNodeList['timestamp'].append(timestamp)
-            childNodeList['meastype'].append(meastype)
-            childNodeList['value'].append(value)
+        parents = []
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                continue
+            parents.pop()
+            if elem.tag != 'meas':
+                continue
+            
+            timestamp = elem.findtext("timestamp")
+            meastype = elem.findtext("type")
+            value = elem.findtext("value")
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
             
-        parsedDataFrame = pd.DataFrame(childNodeList)
-        return parsedDataFrame
+            if n >= size:
+                size *= 2
+                row_codes = np.resize(row_codes, size)
+                column_codes = np.resize(column_codes, size)
+                values = np.resize(values, size)
+            
+            row_codes[n] = rows.setdefault(timestamp, len(rows))
+            column_codes[n] = columns.setdefault(BEACON_MEASTYPES.get(meastype, meastype), len(columns))
+            try:
+                values[n] = float(value)
+            except (TypeError, ValueError):
+                values[n] = np.nan
+            n += 1
+        
+        data = reshape_beacon_data(row_codes[:n], column_codes[:n], values[:n], list(rows), list(columns))
+        data.attrs['count'] = n
+        return data
 
         
     
     #Parse data from Vaisala Beacon cloud database using API
-    def parseFromBeacon(self, startTime):
-        endTime = startTime + datetime.timedelta(days=7)
+    def parseFromBeacon(self, startTime, endTime=None, replay=False):
+        if endTime is None:
+            endTime = startTime + self.window
         payload = {'d': self.mogserial, 'k': self.apiKey, 't0': startTime.strftime("%Y-%m-%dT%H:%M:%S"), 
-                   't1': endTime.strftime("%Y-%m-%dT%H:%M:%S"), 'c' : 90720}
+                   't1': endTime.strftime("%Y-%m-%dT%H:%M:%S"), 'c' : BEACON_ROW_CAP}
         
         times = []
         times.append(datetime.datetime.now())
         print(f'start: {times[0]}')
         
-        try:
-            r = requests.get("http://beacon.vaisala.com/api/?", params=payload)
-            if r.status_code == 200:
-                times.append(datetime.datetime.now())
-                print(f'Got response {(times[1] - times[0]).seconds}')
-                root = ET.fromstring(r.content)
-            else:
-                print(datetime.datetime.now(), 'Error! Response status code:', r.status_code)
-        except requests.exceptions.RequestException as e:  
-            print (datetime.datetime.now(), payload['d'], e)
-            
+        capacity = payload['c']
+        parse = lambda raw: self.stream_xml_file(raw, capacity)
         
-        parsedDataFrame = self.loop_xml_file(root)
+        # Legacy API is skipped for MOG serials which are known to get their
+        # data only from the newer API
+        parsedDataFrame = None
+        if not self.client.skip_legacy(self.mogserial):
+            parsedDataFrame = self.client.fetch("http://beacon.vaisala.com/api/?", payload, parse, replay)
         
-        if parsedDataFrame.empty:
-            try:
-                payload = {'d': self.mogserial, 'k': self.apiKey, 't0': startTime.strftime("%Y-%m-%dT%H:%M:%S"), 't1': 
-                           endTime.strftime("%Y-%m-%dT%H:%M:%S"), 's': f'AQT530-{self.sensor_serial}'}
-                r = requests.get("https://wxbeacon.vaisala.com/api/xml?", params=payload)
-                if r.status_code == 200:
-
-                    times.append(datetime.datetime.now())
-                    print(f'Got response {(times[1] - times[0]).seconds}')
-                    root = ET.fromstring(r.content)
-                else:
-                    print(datetime.datetime.now(), 'Error! Response status code:', r.status_code)
-            except requests.exceptions.RequestException as e:  
-                print (datetime.datetime.now(), payload['d'], e)
-            
-            parsedDataFrame = self.loop_xml_file(root)
+        if parsedDataFrame is None or parsedDataFrame.empty:
+            legacy_empty = parsedDataFrame is not None
+            payload = {'d': self.mogserial, 'k': self.apiKey, 't0': startTime.strftime("%Y-%m-%dT%H:%M:%S"), 't1': 
+                       endTime.strftime("%Y-%m-%dT%H:%M:%S"), 's': f'AQT530-{self.sensor_serial}'}
+            parsedDataFrame = self.client.fetch("https://wxbeacon.vaisala.com/api/xml?", payload, parse, replay)
+            if legacy_empty and parsedDataFrame is not None and not parsedDataFrame.empty:
+                self.client.mark_legacy_empty(self.mogserial)
+        
+        if parsedDataFrame is None:
+            raise BeaconError(f'No valid response for {self.mogserial} between {startTime} and {endTime}')
+        times.append(datetime.datetime.now())
+        print(f'Got and parsed response {(times[1] - times[0]).seconds}')
         
-        parsedDataFrame = pd.pivot_table(parsedDataFrame, index='timestamp',
-                                         columns='meastype', aggfunc='first')
+        # Response which was cut at the API maximum is split in half and both
+        # halves are requested
+        if self.is_truncated(parsedDataFrame, endTime) and endTime - startTime > datetime.timedelta(hours=1):
+            middle = startTime + (endTime - startTime) / 2
+            print(f'Response was cut at {BEACON_ROW_CAP} measurements, splitting window at {middle}')
+            return pd.concat([self.parseFromBeacon(startTime, middle, replay), self.parseFromBeacon(middle, endTime, replay)])
         
-        parsedDataFrame.columns = parsedDataFrame.columns.droplevel()
-        data = parsedDataFrame.rename(columns={'Air Hum.': 'rh', 'Air Pres.':'pres', 'Air Temp.': 'temp',
-                                        'CO': 'co', 'NO': 'no', 'NO2': 'no2', 'O3': 'o3', 'PM10': 'pm10', 
-                                        'PM2.5': 'pm25','PM1': 'pm1', 'Wind Dir.': 'wd', 'Wind Speed': 'ws', 'Rain': 'rain',
-                                        'Air temperature':'temp', 'Air pressure': 'pres', 'Relative humidity': 'rh'})
-
-        data = data.apply(pd.to_numeric, errors = 'coerce')
-        if not data.empty:
-            if not 'pm1' in data.columns: 
-                data['co'] = data['co'] * 1160
-                data['no'] = data['no'] * 1247
-                data['no2'] = data['no2'] * 1912
-                data['o3'] = data['o3'] * 1996
-                data['pm1'] = np.nan
-            else: 
-                data['co'] = data['co'] * 1.160
-                data['no'] = data['no'] * 1.247
-                data['no2'] = data['no2'] * 1.912
-                data['o3'] = data['o3'] * 1.996
-            data = data.round(2)
+        data = convert_beacon_units(parsedDataFrame)
             
         times.append(datetime.datetime.now())
-        print(f'Parsed data {(times[2] - times[1]).seconds}')
+        print(f'Converted data {(times[-1] - times[-2]).seconds}')
         
         return data
     
+    def is_truncated(self, data, endTime):
+        # A response holding the maximum number of measurements is cut only if
+        # it ends before the window does. Count is known from stream_xml_file,
+        # other parsers give only the wide frame.
+        count = data.attrs.get('count', int(data.count().sum()))
+        if data.empty or count < BEACON_ROW_CAP:
+            return False
+        last = pd.to_datetime(data.index).max()
+        if last.tzinfo is not None:
+            last = last.tz_convert('UTC').tz_localize(None)
+        return last < pd.Timestamp(endTime) - datetime.timedelta(minutes=1)
+    
     #Apply correction factors and convert to ug/m3 (from ppm)
     def editBeaconData(self, data):
         data.index = pd.to_datetime(data.index, yearfirst = True).round('T')
@@ -129,15 +234,21 @@ class AQTParser(object):
     
         
    
-    #Inserting data to database after parsing, editing data and flagging. Returns True if no data was parsed
-    def fetchAndEdit(self, starttime):
-        
+    # Converts local (Helsinki) time used in database to UTC used in Beacon API
+    def local_to_utc(self, starttime):
         # TODO: Syksyllä kellonjen siirto kaataa scriptin, koska koodi ei tiedä onko starttime kello 2-3 välillä kesäaikaa vai talviaikaa koska kellonaikoja on kahdet.
         starttime = (starttime + datetime.timedelta(seconds=30)).tz_localize(tz='Europe/Helsinki', ambiguous=False, nonexistent='shift_forward')
         starttime = starttime.tz_convert('UTC')
         starttime = starttime.tz_localize(None)
+        return starttime
+   
+    #Inserting data to database after parsing, editing data and flagging. Returns True if no data was parsed
+    #With replay=True data is read from the Beacon cache of self.client instead of API
+    def fetchAndEdit(self, starttime, endtime=None, local_time=True, replay=False):
+        if local_time:
+            starttime = self.local_to_utc(starttime)
         
-        data = self.parseFromBeacon(starttime)
+        data = self.parseFromBeacon(starttime, endtime, replay)
         if data.empty == True:
             print('No data')
             return data
@@ -147,6 +258,52 @@ class AQTParser(object):
             data['sensor_id'] = self.sensor_id
             
             return data
+    
+    def backfill(self, starttime, write, max_workers=4, window=None):
+        '''
+        Fetches all data from starttime (local time) until now. The range is
+        split to windows that fit in one API response and windows are fetched
+        max_workers at a time. Results are passed to write function strictly in
+        time order, so the ingest watermark stored with each write works as
+        checkpoint: if fetching or writing a window fails (write returns
+        False), later windows are not written and the next backfill
+        continues from the failed window. Returns number of windows written.
+        '''
+        window = self.window if window is None else window
+        start = self.local_to_utc(starttime)
+        end = pd.Timestamp(datetime.datetime.utcnow())
+        windows = []
+        while start < end:
+            windows.append((start, min(start + window, end)))
+            start = start + window
+        print(f'Backfilling {self.sensor_id} from {starttime} in {len(windows)} windows')
+        
+        written = 0
+        workers = max(1, max_workers)
+        remaining = iter(windows)
+        futures = collections.deque()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # At most max_workers windows are fetched or waiting at a time. The
+            # next window is submitted only after the oldest one is written, so
+            # a slow window does not make finished ones pile up in memory.
+            for t0, t1 in itertools.islice(remaining, workers):
+                futures.append((t0, executor.submit(self.fetchAndEdit, t0, t1, False)))
+            while futures:
+                t0, future = futures.popleft()
+                try:
+                    data = future.result()
+                except Exception as e:
+                    print(datetime.datetime.now(), f'Backfill of {self.sensor_id} stopped at {t0}:', e)
+                    break
+                if not data.empty and not write(data):
+                    print(datetime.datetime.now(), f'Backfill of {self.sensor_id} stopped at {t0}: writing failed')
+                    break
+                written += 1
+                for t0, t1 in itertools.islice(remaining, 1):
+                    futures.append((t0, executor.submit(self.fetchAndEdit, t0, t1, False)))
+            for _, pending in futures:
+                pending.cancel()
+        return written
         
         
 def createSession(ini):
@@ -157,7 +314,78 @@ def createSession(ini):
     return session
         
 
-def updateDatabase(session):
+def beacon_types(session, watermarks, sensor_ids):
+    '''
+    Measurement types each sensor sends per minute, read from its latest
+    raw row: 10 if the row has PM1, otherwise 9. Sensors without stored
+    rows are left out and use the default window.
+    '''
+    keys = [(int(sensor_id), resume_time(watermarks, sensor_id, 'Sensor_data_raw')) for sensor_id in sensor_ids]
+    keys = [(sensor_id, timestamp.to_pydatetime()) for sensor_id, timestamp in keys if timestamp is not None]
+    if not keys:
+        return {}
+    latest = pd.read_sql(select(Sensor_data_raw.sensor_id, Sensor_data_raw.pm1).where(
+        tuple_(Sensor_data_raw.sensor_id, Sensor_data_raw.timestamp).in_(keys)), session.bind)
+    has_pm1 = latest.groupby('sensor_id')['pm1'].count() > 0
+    return {sensor_id: BEACON_TYPES_PER_MINUTE_PM1 if pm1 else BEACON_TYPES_PER_MINUTE
+            for sensor_id, pm1 in has_pm1.items()}
+
+
+def fetch_sensor_data(row, starttime, client, types_per_minute=BEACON_TYPES_PER_MINUTE_PM1):
+    # Runs in a worker thread, so only the API call and parsing is done here.
+    # Database writes stay in the calling thread.
+    if client.expired():
+        print(f'Run deadline reached, sensor {row.name} skipped')
+        return pd.DataFrame()
+    aqtObject = AQTParser(row.loc_id, row.mog, row.apikey, row.id, row.serial, client, types_per_minute)
+    return aqtObject.fetchAndEdit(starttime)
+
+
+def qc_history(session, data, minutes=None):
+    # Stored Sensor_data rows of the last minutes before the first row of each
+    # sensor in data, so QC rules spanning several batches see earlier rows
+    if minutes is None:
+        minutes = qualitycontrol.history_minutes()
+    if not minutes:
+        return None
+    first = pd.to_datetime(data['timestamp']).groupby(data['sensor_id']).min()
+    ranges = [(sensor_id, start - datetime.timedelta(minutes=minutes), start - datetime.timedelta(minutes=1))
+              for sensor_id, start in first.items()]
+    return aggregation.read_pending(session, Sensor_data, ranges)
+
+
+def correct_sensor_data(calibration, data, devices=None, history=None):
+    # data may contain any number of sensors
+    data = calibration.correct(data)
+    data = flagErrorData(data, devices=devices, history=history)
+    return data
+
+
+def write_sensor_data(session, calibration, frames, on_conflict='ignore', devices=None):
+    # Raw and corrected data of all frames are written with one COPY per table
+    # in single transaction. If the batch fails, sensors are written one by
+    # one so that one bad frame does not drop data of the other sensors.
+    # Rows already stored (overlapping fetch windows, a rerun) are skipped by
+    # default, because one duplicate would fail the whole COPY against the
+    # unique constraints and stall the watermark. on_conflict=None writes
+    # with plain COPY. Returns False if data of any sensor was not written.
+    try:
+        data = pd.concat(frames, ignore_index=True)
+        history = qc_history(session, data)
+        copy_frames(session, {'Sensor_data_raw': [data],
+                              'Sensor_data': [correct_sensor_data(calibration, data, devices, history)]},
+                    on_conflict)
+    except Exception as e:
+        if len(frames) == 1:
+            print(datetime.datetime.now(), f'Writing data failed for sensor {frames[0].loc[0, "sensor_id"]}:', e)
+            return False
+        print(datetime.datetime.now(), 'Writing batch failed, writing sensors one by one:', e)
+        results = [write_sensor_data(session, calibration, [data], on_conflict, devices) for data in frames]
+        return all(results)
+    return True
+
+
+def updateDatabase(session, max_workers=1, client=None, batch_rows=50000, on_conflict='ignore'):
     # query active locations and sensors
     sensors = pd.read_sql_table('Sensor', con=session.bind)
     sensors = sensors[sensors.active == 1]
@@ -165,94 +393,223 @@ def updateDatabase(session):
         return print(''''Warning! Found 2 or more sensors active with matching serials,
                      please set old duplicate sensors inactive''')
 
+    watermarks = load_watermarks(session)
+    calibration = load_calibration(session, sensors)
+    devices = sensors.set_index('id')['device']
+    types = beacon_types(session, watermarks, sensors.id)
+    jobs = []
     for row in sensors.itertuples():        
-        latest_timestamp = session.query(Sensor_data_raw).filter_by(
-            sensor_id=row.id).order_by(Sensor_data_raw.timestamp.desc()).limit(1).first()
+        latest_timestamp = resume_time(watermarks, row.id, 'Sensor_data_raw')
         if latest_timestamp != None:
-            starttime = pd.Timestamp(latest_timestamp.timestamp)
+            starttime = latest_timestamp
         else:
             starttime = row.date_started
             if starttime > datetime.datetime.now(): # If start_date is in the future skip rest of the loop
                 print(f'Measurements are not started yet. Date started is set to {starttime}')
                 continue
+        jobs.append((row, starttime))
 
-        aqtObject = AQTParser(row.loc_id, row.mog, row.apikey, row.id, row.serial)
-        data = aqtObject.fetchAndEdit(starttime)
+    if client is None:
+        client = BeaconClient(pool_size=max(1, max_workers))
+    
+    # Sensors are fetched and parsed in parallel (max_workers at a time).
+    # Finished frames are collected to batches of about batch_rows rows which
+    # are written to database as soon as they are full. Errors are caught per
+    # sensor so that one failing sensor does not stop the others.
+    batch = []
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(fetch_sensor_data, row, starttime, client,
+                                   types.get(row.id, BEACON_TYPES_PER_MINUTE_PM1)): row for row, starttime in jobs}
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                data = future.result()
+            except Exception as e:
+                print(datetime.datetime.now(), f'Fetching data failed for sensor {row.name} ({row.mog}):', e)
+                continue
 
-        if not data.empty:
-            data.to_sql('Sensor_data_raw', session.bind, index=False, if_exists=('append'))
-            
-            components = ['no2', 'no', 'co', 'o3', 'pm10', 'pm25', 'pm1']
-            data = applyCorrection(sensors, data, components)
-            data = flagErrorData(data)
-            data.to_sql('Sensor_data', session.bind, index=False, if_exists=('append'))
+            if not data.empty:
+                batch.append(data)
+                if sum(len(frame) for frame in batch) >= batch_rows:
+                    write_sensor_data(session, calibration, batch, on_conflict, devices)
+                    batch = []
+    
+    if batch:
+        write_sensor_data(session, calibration, batch, on_conflict, devices)
 
     return 'Latest update {}'.format(pd.Timestamp(datetime.datetime.now()).round('T'))
 
 
 
-def flagErrorData(data):
+def backfillDatabase(session, max_workers=4, client=None, on_conflict='ignore'):
+    '''
+    Catches up active sensors from their latest stored timestamp to current
+    time in one run, however long the gap is. Sensors are handled one by one
+    and windows of each sensor in parallel.
+    '''
+    sensors = pd.read_sql_table('Sensor', con=session.bind)
+    sensors = sensors[sensors.active == 1]
+    watermarks = load_watermarks(session)
+    calibration = load_calibration(session, sensors)
+    devices = sensors.set_index('id')['device']
+    types = beacon_types(session, watermarks, sensors.id)
+    if client is None:
+        client = BeaconClient(pool_size=max(1, max_workers))
+    
+    for row in sensors.itertuples():
+        starttime = resume_time(watermarks, row.id, 'Sensor_data_raw')
+        if starttime is None:
+            starttime = pd.Timestamp(row.date_started)
+            if starttime > datetime.datetime.now():
+                print(f'Measurements are not started yet. Date started is set to {starttime}')
+                continue
+        
+        aqtObject = AQTParser(row.loc_id, row.mog, row.apikey, row.id, row.serial, client,
+                              types.get(row.id, BEACON_TYPES_PER_MINUTE_PM1))
+        aqtObject.backfill(starttime, lambda data: write_sensor_data(session, calibration, [data], on_conflict, devices), max_workers)
+
+
+def replayFromCache(session, client, sensor_ids=None, on_conflict='update'):
+    '''
+    Reprocesses all cached Beacon responses of active sensors (or sensors in
+    sensor_ids) without network access and rewrites raw and corrected data.
+    Needs unique constraints of migrate_database for on_conflict upsert.
+    '''
+    sensors = pd.read_sql_table('Sensor', con=session.bind)
+    sensors = sensors[sensors.active == 1]
+    if sensor_ids is not None:
+        sensors = sensors[sensors.id.isin(sensor_ids)]
+    calibration = load_calibration(session, sensors)
+    devices = sensors.set_index('id')['device']
+    
+    for row in sensors.itertuples():
+        aqtObject = AQTParser(row.loc_id, row.mog, row.apikey, row.id, row.serial, client)
+        for t0, t1 in client.cache.windows(row.mog):
+            try:
+                data = aqtObject.fetchAndEdit(t0, t1, local_time=False, replay=True)
+            except BeaconError as e:
+                print(datetime.datetime.now(), e)
+                continue
+            if not data.empty:
+                write_sensor_data(session, calibration, [data], on_conflict, devices)
+
+
+def flagErrorData(data, rules=None, devices=None, history=None):
+    # Rules are read from qc_rules.csv unless given, see qualitycontrol.py.
+    # history is stored data before data (qc_history).
     df = data.copy()
-    columnsToFlag = ['no2', 'no', 'o3', 'pm10', 'pm25', 'pm1', 'co', 'temp', 'rh']
     df = df.assign(**{'co_flag': 0, 'no_flag': 0, 'no2_flag': 0, 
                       'o3_flag': 0, 'pm10_flag': 0, 'pm25_flag': 0, 'pm1_flag': 0,
                       'rh_flag': 0, 'temp_flag': 0, 'pres_flag': 0})
     
-    for column in columnsToFlag:
-        if column in df.columns:
-            #find consucutive values and flag
-            # labels = df[column].diff().ne(0).cumsum()
-            # df[[column + '_flag']] = (labels.map(labels.value_counts()) >= 40).astype(int)
-            
-            #find too high or low values and flag
-            if column in ['no2', 'no', 'o3', 'pm10', 'pm25', 'pm1']:
-                highValue = 1000
-                lowValue = -5
-            if column in ['co', 'rh']:
-                highValue = 10000
-                lowValue = -5
-            if column == 'temp':
-                highValue = 50
-                lowValue = -40
-        
-            df.loc[(df[column] < lowValue) | (df[column] > highValue), column + '_flag'] = 2
-    
+    df = qualitycontrol.evaluate(df, rules, devices, history)
     return df
 
 
 def applyCorrection(sensors, data, components):
-    df = data.copy()
-    row = sensors[sensors.id == df.loc[0, 'sensor_id']]
-    for component in components:
-        slope = sensors.loc[sensors.id == row.id.values[0], component+'_slope'].values[0]
-        intercept = sensors.loc[sensors.id == row.id.values[0], component+'_bias'].values[0]
-        df[component] = df[component] * slope + intercept
-    return df
+    # Coefficients of Sensor table only, see calibration.load_calibration for
+    # time-versioned coefficients
+    return CalibrationMatrix(sensors, components=components).correct(data)
     
 
 
-def queryBetweenDates(session, sensors, locations, date1, date2):
+def compact_frame(data):
+    '''
+    Measurements as float32, flags as int8 and sensor and location names as
+    categoricals. Takes a fraction of the memory of the default frame.
+    '''
+    for column in data.columns:
+        if column.endswith('_flag'):
+            data[column] = data[column].fillna(0).astype('int8')
+        elif column in aggregation.MEASUREMENTS:
+            data[column] = data[column].astype('float32')
+        elif column in ('sensor_id', 'loc_id'):
+            data[column] = data[column].astype('category')
+    return data
 
-    data = pd.read_sql(session.query(Sensor_data).filter(
-        Sensor_data.timestamp.between(date1, date2)
-    ).statement, session.bind)
 
-    if data.empty:
-        pass
-    
-    for  idx, row in sensors.iterrows():
-        sensors.loc[idx, 'loc_id'] = locations.loc[row['loc_id'], 'name']
+def remove_unused_labels(data):
+    # Filtered compact frames keep all categories, which groupby, pivot_table
+    # and value_counts would still list
+    for column in ('sensor_id', 'loc_id'):
+        if column in data.columns and isinstance(data[column].dtype, pd.CategoricalDtype):
+            data[column] = data[column].cat.remove_unused_categories()
+    return data
 
-    legends = dict(zip(sensors.index.tolist(), sensors.name.tolist()))
-    legends_loc = dict(zip(locations.index.tolist(), locations.name.tolist()))
-    data['sensor_id'] = data['sensor_id'].replace(legends)
-    data['loc_id'] = data['loc_id'].replace(legends_loc)
 
-    data.index = data['timestamp']
-    data = data.drop(columns='timestamp')
-    data = data.sort_values(by=['timestamp', 'loc_id'], ascending=[True, True])
+def between_dates_statement(date1, date2, columns=None, compact=False, order_by='time', table=Sensor_data,
+                            sensor_ids=None):
+    # Rows of table (default Sensor_data) with sensor and location names
+    # joined in the database. Rows are ordered by time and location
+    # (order_by='time') or by sensor and time (order_by='sensor').
+    names = {'sensor_id': Sensor.name.label('sensor_id'), 'loc_id': Location.name.label('loc_id')}
+    if columns is None:
+        selected = [column.name for column in table.__table__.columns]
+    else:
+        selected = [column.name for column in table.__table__.columns
+                    if column.name in ['timestamp', 'sensor_id', 'loc_id'] + list(columns)]
+    if compact:
+        selected = [column for column in selected if column != 'id']
+
+    statement = select(*[names.get(column, table.__table__.columns[column]) for column in selected]).select_from(
+        table.__table__.join(Sensor.__table__, Sensor.id == table.sensor_id).join(
+            Location.__table__, Location.id == table.loc_id)).where(
+        table.timestamp.between(date1, date2))
+    if sensor_ids is not None:
+        statement = statement.where(table.sensor_id.in_([int(sensor_id) for sensor_id in sensor_ids]))
+    if order_by == 'sensor':
+        return statement.order_by(Sensor.name, table.timestamp)
+    return statement.order_by(table.timestamp, Location.name)
+
+
+def between_dates_frame(data, compact=False):
+    if compact:
+        data = compact_frame(data)
+    data.index = pd.to_datetime(data['timestamp'])
+    return data.drop(columns='timestamp')
+
+
+def queryBetweenDates(session, sensors, locations, date1, date2, columns=None, compact=False):
+    '''
+    Sensor_data between dates with sensor and location names, ordered by
+    time and location. columns limits the fetched measurement and flag
+    columns. With compact the frame has no id column and uses compact_frame
+    types. Names are joined in the database, sensors and locations are kept
+    for compatibility.
+    '''
+    data = pd.read_sql(between_dates_statement(date1, date2, columns, compact), session.bind)
+    return between_dates_frame(data, compact)
 
-    return data
+
+def iterBetweenDates(session, date1, date2, by='time', freq='1D', columns=None, compact=False, chunksize=100000):
+    '''
+    Generator of queryBetweenDates frames for long windows. Rows are read
+    through a server-side cursor chunksize rows at a time and yielded as
+    (key, frame) per sensor (by='sensor', key is sensor name) or per time
+    window of freq (by='time', key is start of the window). Memory use is
+    bounded by one group and one chunk.
+    '''
+    def group_keys(data):
+        if by == 'sensor':
+            return data['sensor_id']
+        return pd.to_datetime(data['timestamp']).dt.floor(freq)
+
+    statement = between_dates_statement(date1, date2, columns, compact, order_by=by)
+    with session.bind.connect() as connection:
+        connection = connection.execution_options(stream_results=True)
+        rest = None
+        for chunk in pd.read_sql(statement, connection, chunksize=chunksize):
+            if rest is not None:
+                chunk = pd.concat([rest, chunk], ignore_index=True)
+            keys = group_keys(chunk)
+            # The last group may continue in the next chunk
+            done = (keys != keys.iloc[-1]).to_numpy()
+            for key, data in chunk[done].groupby(keys[done], sort=False):
+                yield key, between_dates_frame(data, compact)
+            rest = chunk[~done]
+        if rest is not None and not rest.empty:
+            for key, data in rest.groupby(group_keys(rest), sort=False):
+                yield key, between_dates_frame(data, compact)
 
 def queryBetweenDates_makelankatu(session, date1, date2):
 
@@ -275,105 +632,189 @@ def queryBetweenDates_makelankatu(session, date1, date2):
 
 
 
-def updateDatabase_hour_avg(session):
-    
-    def count_validity(s):
-        s_valid = s[s==0]
-        not_valid = (len(s_valid) / 60 * 100) < 75
-        return not_valid
-
-    # query active locations and sensors
-    sensors = pd.read_sql_table('Sensor', con=session.bind)
-    sensors = sensors[sensors.active == 1]
-
-    for row in sensors.itertuples():        
-        latest_timestamp = session.query(Sensor_data_60).filter_by(
-            sensor_id=row.id).order_by(Sensor_data_60.timestamp.desc()).limit(1).first()
+def queryHistory(session, sensors, locations, date1, date2, path, table=Sensor_data, columns=None, sensor_ids=None):
+    '''
+    queryBetweenDates for long ranges of any measurement table. Rows before
+    the archived horizon of table are read from the Parquet history store at
+    path (only needed months, sensors and columns) and later rows from the
+    database. Returns frame of the same shape as queryBetweenDates.
+    '''
+    date1, date2 = pd.Timestamp(date1), pd.Timestamp(date2)
+    until = archive.archived_until(path, table.__tablename__)
+    frames = []
+    if until is not None and date1 < until:
+        # Archive stores ids, names are mapped here. Archived rows are all
+        # before the rows of the database, so they are sorted on their own.
+        archived = archive.read_archive(path, table.__tablename__, date1,
+                                        min(date2, until - datetime.timedelta(microseconds=1)),
+                                        columns, sensor_ids)
+        if not archived.empty:
+            archived['sensor_id'] = archived['sensor_id'].map(sensors['name'])
+            archived['loc_id'] = archived['loc_id'].map(locations['name'])
+            frames.append(archived.sort_values(by=['timestamp', 'loc_id'], kind='stable'))
+    if until is None or date2 >= until:
+        statement = between_dates_statement(max(date1, until or date1), date2, columns, table=table,
+                                            sensor_ids=sensor_ids)
+        frames.append(pd.read_sql(statement, session.bind))
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    data = pd.concat(frames, ignore_index=True)
+    data = data[[column.name for column in table.__table__.columns if column.name in data.columns]]
+    return between_dates_frame(data)
+
+
+def rollup_ranges(sensors, watermarks, table, step, end_time):
+    '''
+    (sensor_id, start, end) of source rows not yet averaged to table for
+    each sensor. Rollup resumes one step after the latest written bucket.
+    '''
+    ranges = []
+    for row in sensors.itertuples():
+        latest_timestamp = resume_time(watermarks, row.id, table)
         if latest_timestamp != None:
-            starttime = pd.Timestamp(latest_timestamp.timestamp)
+            starttime = latest_timestamp + step
         else:
             starttime = pd.Timestamp(row.date_started)
-            if starttime > datetime.datetime.now(): # If start_date is in the future skip rest of the loop
-                print(f'Measurements are not started yet. Date started is set to {starttime}')
+            if starttime > datetime.datetime.now(): # If start_date is in the future skip the sensor
+                print(f'Measurements of {row.name} are not started yet. Date started is set to {starttime}')
                 continue
-        end_time = pd.Timestamp(datetime.datetime.now()).floor('H') - datetime.timedelta(minutes=1)
         if end_time < starttime:
-            print('No new data for hourly average calculation')
             continue
-        
-        new_values = pd.read_sql(session.query(Sensor_data).filter(
-                                Sensor_data.timestamp.between(starttime, end_time),
-                                Sensor_data.sensor_id == row.id).order_by(
-                                    Sensor_data.timestamp).statement, session.bind)
-        if not new_values.empty:
-                                    
-            new_values = new_values.fillna(value=np.nan)
-            new_values.index = pd.to_datetime(new_values['timestamp'])
-            new_values.drop(['id', 'timestamp', 'loc_id', 'sensor_id'], axis=1, inplace=True)
-            new_values_flags = new_values.filter(like='flag')
-            new_values = new_values[['no2', 'no', 'o3', 'pm10', 'pm25', 'pm1', 'co', 'temp', 'rh', 'pres']]
-            
-            new_values = new_values.resample('H', label='right').mean().round(2)
-            new_values_flags = new_values_flags.resample('H', label='right').apply(count_validity)
-            new_values = pd.concat([new_values, new_values_flags.astype(int)], axis=1)
-            new_values['loc_id'] = row.loc_id
-            new_values['sensor_id'] = row.id
-            new_values = new_values.reset_index()
-            new_values.to_sql('Sensor_data_60', session.bind, index=False, if_exists=('append'))
-        else:
-            print('No new data found for hourly average calculation')
-        
-        
-def updateDatabase_day_avg(session):
-    
-    def count_validity(s):
-        s_valid = s[s==0]
-        not_valid = (len(s_valid) / 24 * 100) < 75
-        return not_valid
+        ranges.append((row.id, starttime, end_time))
+    return ranges
 
-    # query active locations and sensors
+
+def rollup_table(session, target, sensors, ranges, end_label, backend='pandas'):
+    '''
+    Writes averages of ranges to target table and recomputes its dirty
+    buckets (late data) labelled at or before end_label. Existing averages
+    of the same buckets are overwritten.
+    '''
+    locations = dict(zip(sensors.id, sensors.loc_id))
+    dirty = dirty_ranges(load_dirty(session, target, end_label), target, ranges)
+    source, bucket = aggregation.ROLLUPS[target]
+    averages = {'hour': aggregation.hourly_averages, 'day': aggregation.daily_averages}[bucket]
+    written = 0
+    for pending, fill in ((ranges, True), (dirty, False)):
+        # At most MAX_RANGES ranges per statement. Dirty buckets of each
+        # stored batch are cleared at once, so a failing batch is retried
+        # alone next time.
+        for batch in aggregation.batches(pending):
+            if backend == 'sql':
+                written += aggregation.sql_rollup(session, target, batch, locations, fill)
+            else:
+                new_values = aggregation.read_pending(session, ROLLUP_SOURCES[source], batch)
+                if not new_values.empty:
+                    copy_frames(session, {target: [averages(new_values, locations, fill)]}, on_conflict='update')
+                    written += 1
+            if not fill:
+                clear_dirty_ranges(session, target, batch)
+    if backend != 'sql' and not written:
+        print(f'No new data for {target}')
+    clear_dirty(session, target, end_label)
+    if dirty:
+        print(f'{len(dirty)} ranges with late data recomputed in {target}')
+
+
+def updateDatabase_hour_avg(session, backend='pandas'):
+    '''
+    Hourly averages of all active sensors with one read of Sensor_data and
+    one write to Sensor_data_60. Timestamp is the end of the hour. Hours
+    which got late data are recomputed. With backend='sql' averages are
+    computed inside the database.
+    '''
     sensors = pd.read_sql_table('Sensor', con=session.bind)
-    # sensors = sensors[sensors.active == 1]
+    watermarks = load_watermarks(session)
 
+    # Rows from the end of the latest hour on belong to the next hour
+    end_time = pd.Timestamp(datetime.datetime.now()).floor('H') - datetime.timedelta(minutes=1)
+    ranges = rollup_ranges(sensors[sensors.active == 1], watermarks, 'Sensor_data_60',
+                           datetime.timedelta(0), end_time)
+    rollup_table(session, 'Sensor_data_60', sensors, ranges, end_time + datetime.timedelta(minutes=1), backend)
+
+
+def updateDatabase_day_avg(session, backend='pandas'):
+    '''
+    Daily averages of all sensors with one read of Sensor_data_60 and one
+    write to Sensor_data_1440. Day D is the average of hours 01:00 - 24:00.
+    Days which got late hourly averages are recomputed. With backend='sql'
+    averages are computed inside the database.
+    '''
+    sensors = pd.read_sql_table('Sensor', con=session.bind)
+    watermarks = load_watermarks(session)
+
+    # Day D ends with hourly row D+1 00:00, so next day starts one minute later
+    end_time = pd.Timestamp(datetime.datetime.now()).floor('D')
+    step = datetime.timedelta(days=1, minutes=1)
+    ranges = rollup_ranges(sensors, watermarks, 'Sensor_data_1440', step, end_time)
+    rollup_table(session, 'Sensor_data_1440', sensors, ranges, end_time - datetime.timedelta(days=1), backend)
+
+
+def read_resolution(session, date1, date2, resolution, sensors, watermarks):
+    # Rows with sensor and location ids, labels between date1 and date2.
+    # Precomputed averages are used up to the watermark of their table and
+    # later buckets are averaged from the next finer resolution.
+    ids = sensors.id.tolist()
+    if resolution == 'min':
+        return aggregation.read_pending(session, Sensor_data, [(i, date1, date2) for i in ids])
+
+    table, model, finer, step, averages = {
+        'H': ('Sensor_data_60', Sensor_data_60, 'min', datetime.timedelta(hours=1), aggregation.hourly_averages),
+        'D': ('Sensor_data_1440', Sensor_data_1440, 'H', datetime.timedelta(days=1), aggregation.daily_averages)}[resolution]
+    _, bucket = aggregation.ROLLUPS[table]
+    _, first, last = aggregation.BUCKETS[bucket]
+    stored = aggregation.read_pending(session, model, [(i, date1, date2) for i in ids])
+
+    # Finer rows of buckets after the watermark, or of the whole range.
+    # Bucket labelled L has finer rows from L + first to L + last.
+    tail_starts = {}
+    for i in ids:
+        latest = resume_time(watermarks, i, table)
+        if latest is None or latest < date1:
+            tail_starts[i] = date1 + first
+        elif latest < date2:
+            tail_starts[i] = latest + step + first
+    if not stored.empty:
+        latest_stored = pd.to_datetime(stored['sensor_id'].map(lambda i: resume_time(watermarks, i, table)))
+        stored = stored[stored['timestamp'] <= latest_stored.fillna(pd.Timestamp.max)]
+    if not tail_starts:
+        return stored
+
+    finer_data = read_resolution(session, min(tail_starts.values()), date2 + last, finer,
+                                 sensors[sensors.id.isin(list(tail_starts))], watermarks)
+    if finer_data.empty:
+        return stored
+    finer_data = finer_data[finer_data['timestamp'] >= finer_data['sensor_id'].map(tail_starts)]
+    # Location of the averaged rows, not the current one of the sensor
+    tail = averages(finer_data, None, fill=False)
+    tail = tail[tail['timestamp'].between(date1, date2)]
+    return pd.concat([stored, tail], ignore_index=True)
+
+
+def queryResolution(session, date1, date2, resolution='H', components=None, compact=False):
+    '''
+    Data of components between dates at resolution 'min' (Sensor_data), 'H'
+    (Sensor_data_60) or 'D' (Sensor_data_1440) with sensor and location
+    names, in the shape of queryBetweenDates. Averages are read from the
+    precomputed table and only buckets newer than its watermark are averaged
+    on the fly, so consumers do not need to resample minute data. Hourly
+    labels are the end of the hour and day D is hours 01:00 - 24:00.
+    '''
+    date1, date2 = pd.Timestamp(date1), pd.Timestamp(date2)
+    sensors = pd.read_sql_table('Sensor', con=session.bind)
+    locations = pd.read_sql_table('Location', con=session.bind).set_index('id')
+    data = read_resolution(session, date1, date2, resolution, sensors, load_watermarks(session))
+    if data.empty:
+        return data
+
+    components = aggregation.MEASUREMENTS if components is None else list(components)
+    data = data[['sensor_id', 'loc_id', 'timestamp'] + components + [c + '_flag' for c in components]].copy()
+    data['sensor_id'] = data['sensor_id'].map(sensors.set_index('id')['name'])
+    data['loc_id'] = data['loc_id'].map(locations['name'])
+    data = data.sort_values(by=['timestamp', 'loc_id'])
+    return between_dates_frame(data, compact)
 
-    for row in sensors.itertuples():        
-        latest_timestamp = session.query(Sensor_data_1440).filter_by(
-            sensor_id=row.id).order_by(Sensor_data_1440.timestamp.desc()).limit(1).first()
-        if latest_timestamp != None:
-            starttime = pd.Timestamp(latest_timestamp.timestamp) + datetime.timedelta(minutes=1)
-        else:
-            starttime = pd.Timestamp(row.date_started)
-            if starttime > datetime.datetime.now(): # If start_date is in the future skip rest of the loop
-                print(f'Measurements are not started yet. Date started is set to {starttime}')
-                continue
-        
-        end_time = pd.Timestamp(datetime.datetime.now()).floor('D')
-        if (end_time - datetime.timedelta(days=1)) < starttime:
-            print('No new data for day average calculation')
-            continue
-        
-        new_values = pd.read_sql(session.query(Sensor_data_60).filter(
-                                Sensor_data_60.timestamp.between(starttime, end_time),
-                                Sensor_data_60.sensor_id == row.id).order_by(
-                                    Sensor_data_60.timestamp).statement, session.bind)
-                                    
-        new_values = new_values.fillna(value=np.nan)
-        new_values.index = pd.to_datetime(new_values['timestamp'])
-        new_values.drop(['id', 'timestamp', 'loc_id', 'sensor_id'], axis=1, inplace=True)
-        new_values_flags = new_values.filter(like='flag')
-        new_values = new_values[['no2', 'no', 'o3', 'pm10', 'pm25', 'pm1', 'co', 'temp', 'rh', 'pres']]
-        
-        new_values = new_values.resample('D', offset=1, label='left').mean().round(2)
-        new_values_flags = new_values_flags.resample('D', offset=1, label='left').apply(count_validity)
-        new_values = pd.concat([new_values, new_values_flags.astype(int)], axis=1)
-        new_values['loc_id'] = row.loc_id
-        new_values['sensor_id'] = row.id
-        new_values.index = new_values.index.round('D').strftime('%Y-%m-%d')
-        
-        new_values = new_values.reset_index()
-        new_values.to_sql('Sensor_data_1440', session.bind, index=False, if_exists=('append'))
-        # break
-    # return new_values
 
 def delete_rows_between_dates(session, date1, date2, table):
     
@@ -382,6 +823,10 @@ def delete_rows_between_dates(session, date1, date2, table):
     values.delete(synchronize_session=False)
     session.commit()
     print(f'{len(df)} rows deleted between {date1} and {date2}')
+    
+    # Resume points must move back to the latest remaining rows
+    if table.__tablename__ in ('Sensor_data_raw', 'Sensor_data_60', 'Sensor_data_1440'):
+        rebuild_watermarks(session, [table.__tablename__])
 
 
 # stmt = (
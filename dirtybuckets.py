@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Dirty buckets: hourly and daily averages whose source rows were written
+after the average was computed (late data). Kept in Dirty_bucket table and
+recomputed by the next rollup.
+
+@author: Taneli Mäkelä
+"""
+import datetime
+import pandas as pd
+from sqlalchemy import and_, bindparam, text
+from database import Dirty_bucket
+from watermarks import TARGETS
+from aggregation import ROLLUPS, BUCKETS
+
+INSERT = '''INSERT INTO "Dirty_bucket" (sensor_id, target, timestamp) VALUES (%s, %s, %s)
+            ON CONFLICT DO NOTHING'''
+
+
+def create_dirty_table(session, tables):
+    # Ingest may write before the first rollup has created the table
+    if any(source in tables for source, _ in ROLLUPS.values()):
+        Dirty_bucket.__table__.create(session.bind, checkfirst=True)
+
+
+def mark_dirty(cursor, table, data):
+    # Called inside the transaction of the write, like update_watermarks.
+    # Every bucket of the next rollup that got rows is marked.
+    for target, (source, bucket) in ROLLUPS.items():
+        if source != table or data.empty:
+            continue
+        labels = BUCKETS[bucket][0](pd.to_datetime(data['timestamp']))
+        dirty = pd.DataFrame({'sensor_id': data['sensor_id'], 'timestamp': labels}).drop_duplicates()
+        cursor.executemany(INSERT, [(int(row.sensor_id), TARGETS[target], row.timestamp.to_pydatetime())
+                                    for row in dirty.itertuples()])
+
+
+def load_dirty(session, target, end):
+    '''
+    Dirty buckets of target table labelled at or before end, as dataframe
+    with sensor_id and timestamp columns.
+    '''
+    Dirty_bucket.__table__.create(session.bind, checkfirst=True)
+    dirty = pd.read_sql(session.query(Dirty_bucket.sensor_id, Dirty_bucket.timestamp).filter(
+                            Dirty_bucket.target == TARGETS[target],
+                            Dirty_bucket.timestamp <= end).statement, session.bind)
+    dirty['timestamp'] = pd.to_datetime(dirty['timestamp'])
+    return dirty
+
+
+def dirty_ranges(dirty, target, ranges):
+    '''
+    Source row ranges [(sensor_id, start, end)] of dirty buckets that are
+    not covered by ranges of the normal rollup from the watermark on.
+    Adjacent and overlapping buckets of a sensor are merged to one range,
+    so late data over weeks gives a few ranges instead of one per bucket.
+    '''
+    if dirty.empty:
+        return []
+    _, bucket = ROLLUPS[target]
+    _, first, last = BUCKETS[bucket]
+    starts = pd.Series({sensor_id: start for sensor_id, start, _ in ranges}, dtype='datetime64[ns]')
+    pending = pd.DataFrame({'sensor_id': dirty['sensor_id'], 'start': dirty['timestamp'] + first,
+                            'end': dirty['timestamp'] + last})
+    normal = pending['sensor_id'].map(starts)
+    pending = pending[normal.isna() | (pending['start'] < normal)].sort_values(['sensor_id', 'start'])
+
+    # Source rows are whole minutes, so a range starting one minute after
+    # the end of the previous one continues it
+    reach = pending.groupby('sensor_id')['end'].cummax().groupby(pending['sensor_id']).shift()
+    group = (reach.isna() | (pending['start'] > reach + datetime.timedelta(minutes=1))).cumsum()
+    merged = pending.groupby(group).agg(sensor_id=('sensor_id', 'first'), start=('start', 'min'), end=('end', 'max'))
+    return [(int(sensor_id), start, end) for sensor_id, start, end in merged.itertuples(index=False)]
+
+
+def clear_dirty_ranges(session, target, ranges):
+    # Dirty buckets of recomputed ranges, cleared after each stored batch so
+    # a later failing batch does not make the next rollup redo this one
+    _, bucket = ROLLUPS[target]
+    _, first, last = BUCKETS[bucket]
+    if not ranges:
+        return
+    table = Dirty_bucket.__table__
+    statement = table.delete().where(and_(table.c.target == TARGETS[target], table.c.sensor_id == bindparam('sensor'),
+                                          table.c.timestamp.between(bindparam('first'), bindparam('last'))))
+    with session.bind.begin() as connection:
+        connection.execute(statement, [{'sensor': int(sensor_id), 'first': pd.Timestamp(start - first).to_pydatetime(),
+                                        'last': pd.Timestamp(end - last).to_pydatetime()}
+                                       for sensor_id, start, end in ranges])
+
+
+def clear_dirty(session, target, end):
+    # Called after the rollup is stored. If the rollup fails, buckets stay
+    # dirty and are recomputed next time.
+    with session.bind.begin() as connection:
+        connection.execute(text('DELETE FROM "Dirty_bucket" WHERE target = :target AND timestamp <= :end'),
+                           {'target': TARGETS[target], 'end': pd.Timestamp(end).to_pydatetime()})
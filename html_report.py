@@ -7,11 +7,43 @@ Created on Tue May  4 14:20:40 2021
 import numpy as np
 import pandas as pd
 import datetime
+import os
 import plotly.express as px
 import plotly.offline
 import jinja2
+import jinja2.meta
+from concurrent.futures import ProcessPoolExecutor
+from stationdata import read_ilmanetcsv
 
 
+# Regions of HOPE sensor locations, one facet of the line figure each
+HOPE_REGIONS = {"Makelankatu":'Vallila',
+                "Marian sairaala":'Jatkasaari1',
+                "Lansisatamankatu 34":'Jatkasaari2',
+                "Selkamerenkatu 3":'Jatkasaari2',
+                "Valimerenkatu 5":'Jatkasaari2',
+                "Tyynenmerenkatu 3":'Jatkasaari2',
+                "Lansisatamankatu apt":'Jatkasaari2',
+                "Hyvantoivonkatu 7":'Jatkasaari1',
+                "Atlankatinkatu 5":'Jatkasaari1',
+                "Atlantinkatu 18":'Jatkasaari1',
+                "Tyynenmerenkatu 14":'Jatkasaari2',
+                "Hernesaari":'Jatkasaari1',
+                "Teollisuuskatu 23":'Vallila',
+                "Teollisuuskatu 3":'Vallila',
+                "Sturenkatu 22":'Vallila',
+                "Hameentie 95":'Vallila',
+                "Smear III":'Vallila',
+                "Hameentie 115":'Vallila',
+                "Pirjontie 43":'Pakila1',
+                "Pakilantie 55":'Pakila1',
+                "Kylakunnantie 19":'Pakila1',
+                "Palosuontie 2":'Pakila2',
+                "Elonkuja 3":'Pakila2',
+                "Kansantie 37":'Pakila1',
+                "Elontie 111":'Pakila2',
+                "Sysimiehentie 44":'Pakila2'}
+
 
 def plotlyplot_line(df1, legend_layout='bottom'):
     color_map = ['#379f9b', '#f18931', '#006431', '#bd3429',
@@ -39,6 +71,25 @@ def plotlyplot_line(df1, legend_layout='bottom'):
     fig.update_traces(patch={"line": {'width':4, 'color': 'grey'}}, selector={'legendgroup': 'Refenrenssi'})
     return fig
 
+def plotlyplot_line_hope(df1, regions):
+    color_map = ['#379f9b', '#f18931', '#006431', '#bd3429',
+                 '#814494', '#d82e8a', '#74aa50', '#006aa7']
+    x1 = df1.index[0]
+    x2 = df1.index[-1] + datetime.timedelta(hours=3)
+    df1 = df1.melt(ignore_index=False, var_name='variable', value_name='value')
+    df1['region'] = df1['variable']
+    df1['region'] = df1['region'].replace(regions)
+
+    y1=df1['value'].min() - 3
+    y2=df1['value'].max() + df1['value'].max() * 0.1
+
+    fig = px.line(df1, x=df1.index, y="value", color="variable", facet_row='region', width=1000, height=2100,
+                  range_x=[x1, x2],range_y=[y1,y2], template='ggplot2', color_discrete_sequence=color_map)
+
+    fig.update_traces(patch={"line": {'width':4, 'color': 'grey'}}, selector={'legendgroup': 'Makelankatu'})
+    fig.update_traces(patch={"line": {'width':4, 'color': 'grey'}}, selector={'legendgroup': 'Refenrenssi'})
+    return fig
+
 def plotlyplot_bar(df1):
     color_map = ['#379f9b', '#f18931', '#006431', '#bd3429',
                  '#814494', '#d82e8a', '#74aa50', '#006aa7']
@@ -117,24 +168,6 @@ def createTable(df):
     return df_style
 
 
-def read_ilmanetcsv(data_path):
-    def customDateTime(datestr):
-        if '24:00' in datestr:
-            datestr = datestr.replace('24:00', '00:00')
-            return pd.to_datetime(datestr, format="%d.%m.%Y %H:%M") + datetime.timedelta(days=1)
-        else:
-            return pd.to_datetime(datestr, format="%d.%m.%Y %H:%M")
-        
-    data = pd.read_csv(data_path, header=[0,1,2], parse_dates=True)
-    data = data.drop(columns=data.filter(like='22').columns)
-    data.columns = data.columns.droplevel(1)
-    data.iloc[:,0] = data.iloc[:,0].apply(customDateTime)
-    data = data.set_index(data.iloc[:,0])
-    data.index = pd.to_datetime(data.index, format="%d.%m.%Y %H:%M")
-    data = data.apply(pd.to_numeric, errors='coerce')
-    data = data.rename(columns=str.lower).rename(columns={'pm2_5': 'pm25'})
-    return data
-
 def parse_station_data(data_path_stations):
     data = read_ilmanetcsv(data_path_stations)
     
@@ -142,7 +175,7 @@ def parse_station_data(data_path_stations):
     data[data==-9999] = np.nan
     return data
 
-def create_station_graph_div(station_data, component):
+def station_graph_data(station_data, component):
     data = station_data.filter(like=component).shift(periods=-1, freq='H')
     data = data.resample('D', label='left').mean().iloc[1:, :].round(1)
     data = data.dropna(how='all', axis=1)
@@ -151,7 +184,10 @@ def create_station_graph_div(station_data, component):
                 '12_pm10': 'Hämeenlinnanväylä','13_pm10': 'Lentokenttä','14_pm10': 'Järvenpää','17_pm10': 'Ammassuo 2','18_pm10': 'Makelankatu',
                 '20_pm10': 'Blominmaki'}
     data.rename(columns=data_columns, inplace = True)
-    data_div = plotly.offline.plot(plotlyplot_bar(data), show_link=False, output_type='div')
+    return data
+
+def create_station_graph_div(station_data, component):
+    data_div = plotly.offline.plot(plotlyplot_bar(station_graph_data(station_data, component)), show_link=False, output_type='div')
     return data_div
     
 
@@ -162,13 +198,87 @@ def loadTemplate(path, template):
     template = templateEnv.get_template(TEMPLATE_FILE)
     return template
 
-    
 
-def createReport(data_Aqt, data_path_stations, savePath, template_folder, template_name, station_id=None, online=True, kartta='sensorikartta.html', legend_layout='bottom'):
+# The only plotly.js of a report, same version as the figures are made for
+PLOTLYJS = f'<script src="https://cdn.plot.ly/plotly-{plotly.offline.get_plotlyjs_version()}.min.js"></script>'
+
+# Placeholder of a figure whose JSON spec is in a separate script file
+# (figures_script). The file is a script and not fetched JSON, so reports
+# also work opened from disk. Figures are drawn when the page is parsed, so
+# the file may be loaded anywhere in the page.
+FIGURE_LOADER = """<div id="figure-{key}" class="plotly-graph-div"></div>
+<script>
+document.addEventListener("DOMContentLoaded", function () {{ Plotly.newPlot("figure-{key}", window.reportFigures["{key}"]); }});
+</script>"""
+
+
+def figure_output(plot, args, output='div'):
+    # Runs in a worker process of render_divs, so plot must be a module
+    # level function. Reports load plotly.js once (render_report), so it
+    # is not included in the divs.
+    fig = plot(*args)
+    if output == 'json':
+        return fig.to_json()
+    return plotly.offline.plot(fig, show_link=False, include_plotlyjs=False, output_type='div')
+
+
+def render_divs(jobs, max_workers=1, json_path=None):
+    '''
+    Builds and serializes figures of jobs {key: (plot function, args)} and
+    returns {key: div}. With max_workers other than 1 figures are built in
+    a process pool (0 uses all cores). Calling script must start from an
+    if __name__ == '__main__' block. With json_path the JSON specs of all
+    figures are written to that script file (next to the report, loaded
+    with figures_script) and the divs only draw them.
+    '''
+    output = 'div' if json_path is None else 'json'
+    if max_workers == 1:
+        rendered = {key: figure_output(plot, args, output) for key, (plot, args) in jobs.items()}
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers or None) as executor:
+            futures = {key: executor.submit(figure_output, plot, args, output) for key, (plot, args) in jobs.items()}
+            rendered = {key: future.result() for key, future in futures.items()}
+    if json_path is None:
+        return rendered
+
+    with open(json_path, 'w', encoding='utf-8') as figures:
+        figures.write('window.reportFigures = {' + ','.join(f'"{key}":{spec}' for key, spec in rendered.items()) + '};')
+    return {key: FIGURE_LOADER.format(key=key) for key in rendered}
+
+
+def figures_json_path(savePath, json_figures):
+    return os.path.splitext(savePath)[0] + '.figures.js' if json_figures else None
+
+
+def figures_script(json_path):
+    # Script tag of the figure file written by render_divs. Query string
+    # changes on every build, so browsers do not draw old figures.
+    if json_path is None:
+        return ''
+    return f'<script src="{os.path.basename(json_path)}?v={datetime.datetime.now():%Y%m%d%H%M}"></script>'
+
+
+def render_report(template, scripts='', **context):
+    '''
+    Renders report template with plotly.js (PLOTLYJS) and scripts loaded
+    once. Templates place them with {{ plotlyjs }}. Templates without it
+    (e.g. older ones in template_folder) get them at the end of head.
+    '''
+    scripts = PLOTLYJS + scripts
+    environment = template.environment
+    source = environment.loader.get_source(environment, template.name)[0]
+    if 'plotlyjs' in jinja2.meta.find_undeclared_variables(environment.parse(source)):
+        return template.render(plotlyjs=scripts, **context)
+    output = template.render(**context)
+    if '</head>' in output:
+        return output.replace('</head>', scripts + '\n</head>', 1)
+    return scripts + '\n' + output
+
+    
+def createReport(data_Aqt, data_path_stations, savePath, template_folder, template_name, station_id=None, online=True, kartta='sensorikartta.html', legend_layout='bottom', max_workers=1, json_figures=False):
     components = ['no2', 'no', 'co', 'o3', 'pm10', 'pm25', 'rh', 'temp']
     
     station_data = parse_station_data(data_path_stations)
-    pm10_div = create_station_graph_div(station_data, 'pm10')
     
     
     data_dict = {}
@@ -186,130 +296,70 @@ def createReport(data_Aqt, data_path_stations, savePath, template_folder, templa
         
     
     
-    figs = {}
-    figs_D = {}
-
+    jobs = {'pm10_station': (plotlyplot_bar, (station_graph_data(station_data, 'pm10'),))}
     for component, data in data_dict.items():
-        figs[component] = plotlyplot_line(data, legend_layout=legend_layout)
-        figs_D[component] = plotlyplot_bar(data.resample('D', label='left').mean())  
-        
-    
-    divs = {}
-    divs_D = {}
-    for component, fig in figs.items():
-        divs[component] = plotly.offline.plot(fig, show_link=False, output_type='div')
-        
-    for component, fig in figs_D.items():
-        divs_D[component] = plotly.offline.plot(fig, show_link=False, output_type='div')
+        jobs[f'line_{component}'] = (plotlyplot_line, (data, legend_layout))
+        jobs[f'bar_{component}'] = (plotlyplot_bar, (data.resample('D', label='left').mean(),))
+    json_path = figures_json_path(savePath, json_figures)
+    rendered = render_divs(jobs, max_workers, json_path)
     
+    pm10_div = rendered['pm10_station']
+    divs = {component: rendered[f'line_{component}'] for component in data_dict}
+    divs_D = {component: rendered[f'bar_{component}'] for component in data_dict}
 
                  
 
     aika = datetime.datetime.today().strftime("%Y-%m-%d %H:%M")
     template = loadTemplate(template_folder, template_name)
-    outputText = template.render(aika=aika, divs = divs, divs_D = divs_D, pm10_div=pm10_div, kartta=kartta)
+    outputText = render_report(template, figures_script(json_path), aika=aika, divs = divs, divs_D = divs_D, pm10_div=pm10_div, kartta=kartta)
 
         
     with open(savePath, 'w', encoding='utf-8') as report:
         report.write(outputText)
 
 
-def create_colocation_report(data_Aqt, data_path_stations, savePath, template_folder, template_name, station_id=None):
+def create_colocation_report(data_colocation, savePath, template_folder, template_name, max_workers=1, json_figures=False):
+    '''
+    Colocation report of hourly sensor data joined to the reference station
+    in the database (referencedata.queryColocation).
+    '''
     # components = ['no2', 'no', 'o3', 'co', 'pm10', 'pm25', 'rh', 'temp']
     components = ['no2','pm10', 'pm25', 'rh', 'temp']
     
-    station_data = parse_station_data(data_path_stations)
-    
     data_dict = {}
     for component in components:
-        data = data_Aqt[[component, 'sensor_id']]
-        data = pd.pivot_table(data, values=component,
-                              index=data.index, columns='sensor_id')
-        data = data.resample('H', label='right').mean().round(1)
-        if station_id != None:
-            if component in ['no', 'no2', 'pm10', 'pm25', 'o3']:
-                refData = station_data.filter(like=f'{station_id}_')
-                data = pd.concat([data, refData.loc[:, f'{station_id}_{component}'].rename('Referenssi')],axis=1)
+        data = pd.pivot_table(data_colocation, values=component,
+                              index=data_colocation.index, columns='sensor_id').round(1)
+        reference = f'{component}_reference'
+        if reference in data_colocation.columns:
+            # One reference value per hour, repeated on each sensor row
+            refData = data_colocation[reference].groupby(level=0).first()
+            data = pd.concat([data, refData.rename('Referenssi')], axis=1)
         data_dict[component] = data
     
-    figs = {}
-    figs_scatter = {}
+    jobs = {}
     for component, data in data_dict.items():
-        figs[component] = plotlyplot_line(data)
-
-    for component, data in data_dict.items():
-        if component in ['no', 'no2', 'pm10', 'pm25', 'o3']:
-            figs_scatter[component] = plotlyplot_scatter(data, 'Referenssi')
+        jobs[f'line_{component}'] = (plotlyplot_line, (data,))
+        if 'Referenssi' in data.columns:
+            jobs[f'scatter_{component}'] = (plotlyplot_scatter, (data, 'Referenssi'))
+    json_path = figures_json_path(savePath, json_figures)
+    rendered = render_divs(jobs, max_workers, json_path)
         
-    divs = {}
-    divs_scatter = {}
-    for component, fig in figs.items():
-        divs[component] = plotly.offline.plot(fig, show_link=False, include_plotlyjs=False, output_type='div')      
-
-    for component, fig in figs_scatter.items():
-        divs_scatter[component] = plotly.offline.plot(fig, show_link=False, include_plotlyjs=False, output_type='div')     
+    divs = {component: rendered[f'line_{component}'] for component in data_dict}
+    divs_scatter = {component: rendered[f'scatter_{component}'] for component in data_dict if f'scatter_{component}' in rendered}
         
     aika = datetime.datetime.today().strftime("%Y-%m-%d %H:%M")
     template = loadTemplate(template_folder, template_name)
-    outputText = template.render(aika=aika, divs = divs, divs_scatter = divs_scatter)
+    outputText = render_report(template, figures_script(json_path), aika=aika, divs = divs, divs_scatter = divs_scatter)
 
         
     with open(savePath, 'w', encoding='utf-8') as report:
         report.write(outputText)
         
         
-def create_HOPE_report(data_Aqt, data_path_stations, savePath, template_folder, template_name, station_id=None, online=True, kartta='hopekartta.html', legend_layout='bottom'):
+def create_HOPE_report(data_Aqt, data_path_stations, savePath, template_folder, template_name, station_id=None, online=True, kartta='hopekartta.html', legend_layout='bottom', max_workers=1, json_figures=False):
     components = ['no2', 'no', 'co', 'o3', 'pm10', 'pm25', 'rh', 'temp']
     
-    station_data = parse_station_data(data_path_stations)
-    pm10_div = create_station_graph_div(station_data, 'pm10')
-    
-    regions = {"Makelankatu":'Vallila',
-                "Marian sairaala":'Jatkasaari1',
-                "Lansisatamankatu 34":'Jatkasaari2',
-                "Selkamerenkatu 3":'Jatkasaari2',
-                "Valimerenkatu 5":'Jatkasaari2',
-                "Tyynenmerenkatu 3":'Jatkasaari2',
-                "Lansisatamankatu apt":'Jatkasaari2',
-                "Hyvantoivonkatu 7":'Jatkasaari1',
-                "Atlankatinkatu 5":'Jatkasaari1',
-                "Atlantinkatu 18":'Jatkasaari1',
-                "Tyynenmerenkatu 14":'Jatkasaari2',
-                "Hernesaari":'Jatkasaari1',
-                "Teollisuuskatu 23":'Vallila',
-                "Teollisuuskatu 3":'Vallila',
-                "Sturenkatu 22":'Vallila',
-                "Hameentie 95":'Vallila',
-                "Smear III":'Vallila',
-                "Hameentie 115":'Vallila',
-                "Pirjontie 43":'Pakila1',
-                "Pakilantie 55":'Pakila1',
-                "Kylakunnantie 19":'Pakila1',
-                "Palosuontie 2":'Pakila2',
-                "Elonkuja 3":'Pakila2',
-                "Kansantie 37":'Pakila1',
-                "Elontie 111":'Pakila2',
-                "Sysimiehentie 44":'Pakila2'}
-    
-    def plotlyplot_line_hope(df1, regions):
-        color_map = ['#379f9b', '#f18931', '#006431', '#bd3429',
-                     '#814494', '#d82e8a', '#74aa50', '#006aa7']
-        x1 = df1.index[0]
-        x2 = df1.index[-1] + datetime.timedelta(hours=3)
-        df1 = df1.melt(ignore_index=False, var_name='variable', value_name='value')
-        df1['region'] = df1['variable']
-        df1['region'] = df1['region'].replace(regions)
-        
-        y1=df1['value'].min() - 3
-        y2=df1['value'].max() + df1['value'].max() * 0.1
-    
-        fig = px.line(df1, x=df1.index, y="value", color="variable", facet_row='region', width=1000, height=2100,
-                      range_x=[x1, x2],range_y=[y1,y2], template='ggplot2', color_discrete_sequence=color_map)
-        
-        fig.update_traces(patch={"line": {'width':4, 'color': 'grey'}}, selector={'legendgroup': 'Makelankatu'})
-        fig.update_traces(patch={"line": {'width':4, 'color': 'grey'}}, selector={'legendgroup': 'Refenrenssi'})
-        return fig
-    
     station_data = parse_station_data(data_path_stations)
     
     data_dict = {}
@@ -324,28 +374,22 @@ def create_HOPE_report(data_Aqt, data_path_stations, savePath, template_folder,
                 data = pd.concat([data, refData.loc[:, f'{station_id}_{component}'].rename('Makelankatu')],axis=1)
         data_dict[component] = data
     
-    figs = {}
-    figs_D = {}
-
+    jobs = {'pm10_station': (plotlyplot_bar, (station_graph_data(station_data, 'pm10'),))}
     for component, data in data_dict.items():
-        figs[component] = plotlyplot_line_hope(data, regions)
-        figs_D[component] = plotlyplot_bar(data.resample('D', label='left').mean())  
-        
-    
-    divs = {}
-    divs_D = {}
-    for component, fig in figs.items():
-        divs[component] = plotly.offline.plot(fig, show_link=False, output_type='div')
-        
-    for component, fig in figs_D.items():
-        divs_D[component] = plotly.offline.plot(fig, show_link=False, output_type='div')
+        jobs[f'line_{component}'] = (plotlyplot_line_hope, (data, HOPE_REGIONS))
+        jobs[f'bar_{component}'] = (plotlyplot_bar, (data.resample('D', label='left').mean(),))
+    json_path = figures_json_path(savePath, json_figures)
+    rendered = render_divs(jobs, max_workers, json_path)
     
+    pm10_div = rendered['pm10_station']
+    divs = {component: rendered[f'line_{component}'] for component in data_dict}
+    divs_D = {component: rendered[f'bar_{component}'] for component in data_dict}
 
                  
 
     aika = datetime.datetime.today().strftime("%Y-%m-%d %H:%M")
     template = loadTemplate(template_folder, template_name)
-    outputText = template.render(aika=aika, divs = divs, divs_D = divs_D, pm10_div=pm10_div, kartta=kartta)
+    outputText = render_report(template, figures_script(json_path), aika=aika, divs = divs, divs_D = divs_D, pm10_div=pm10_div, kartta=kartta)
 
         
     with open(savePath, 'w', encoding='utf-8') as report:
@@ -10,10 +10,26 @@ import folium
 import dbqueries
 import airqualitymap
 import html_report
+import reportcache
+import stationdata
+import referencedata
+import partitions
+import archive
 import os
+from beaconclient import BeaconClient
+from beaconcache import BeaconCache
 
+# Columns used by the report and the map
+REPORT_COLUMNS = ['no2', 'no', 'co', 'o3', 'pm10', 'pm25', 'rh', 'temp',
+                  'co_flag', 'no_flag', 'no2_flag', 'o3_flag', 'pm10_flag', 'pm25_flag']
 
-def query_data_for_report(session, days):
+# Sensors and columns of the colocation report
+COLOCATION_SENSORS = ['HSYS001', 'HSYS002', 'HSYS004','HSYS015', 'HSYS017', 'HSYS018', 'HSYS019',
+                      'HSYS020', 'HSYS021', 'HSYS022','HSYS023', 'HSYS024']
+COLOCATION_COLUMNS = ['no2', 'pm10', 'pm25', 'rh', 'temp']
+
+
+def query_data_for_report(session, days, cache=None):
     date1 = (pd.Timestamp(datetime.datetime.now() - 
                           datetime.timedelta(days=days, 
                             hours=datetime.datetime.now().hour,
@@ -24,7 +40,12 @@ def query_data_for_report(session, days):
     
     sensorLocations = pd.read_sql_table('Location', con=session.bind).set_index('id')
     
-    data_all = dbqueries.queryBetweenDates(session, sensors, sensorLocations, date1, date2)
+    if cache is not None:
+        data_all = reportcache.query_window(session, sensors, sensorLocations, date1, date2, cache,
+                                            columns=REPORT_COLUMNS)
+    else:
+        data_all = dbqueries.queryBetweenDates(session, sensors, sensorLocations, date1, date2,
+                                               columns=REPORT_COLUMNS, compact=True)
         
     return data_all, data_all.empty
 
@@ -52,33 +73,58 @@ def Main():
     ini_file = os.path.join(os.path.dirname(__file__), 'iniFile.csv')
     ini = pd.read_csv(ini_file, sep= '\t', index_col=0)
     session = dbqueries.createSession(ini)
+    if 'station_cache' in ini.index:
+        stationdata.CACHE_DIR = ini.loc['station_cache'][0]
     
     # Poll data from Vaisala API and insert to database
     # -------------------------------------------------------------------------
-    dbqueries.updateDatabase(session)
+    max_workers = int(ini.loc['ingest_workers'][0]) if 'ingest_workers' in ini.index else 1
+    deadline = None
+    if 'ingest_minutes' in ini.index:
+        deadline = datetime.datetime.now() + datetime.timedelta(minutes=float(ini.loc['ingest_minutes'][0]))
+    state_file = ini.loc['beacon_state'][0] if 'beacon_state' in ini.index else None
+    cache = None
+    if 'beacon_cache' in ini.index:
+        max_days = float(ini.loc['beacon_cache_days'][0]) if 'beacon_cache_days' in ini.index else None
+        cache = BeaconCache(ini.loc['beacon_cache'][0], max_days=max_days)
+    client = BeaconClient(pool_size=max_workers, deadline=deadline, state_file=state_file, cache=cache)
+    on_conflict = ini.loc['upsert'][0] if 'upsert' in ini.index else 'ignore'
+    partitions.ensure_partitions(session)
+    if 'backfill' in ini.index and int(ini.loc['backfill'][0]):
+        # Sensors with long outages are caught up to current time in windows
+        dbqueries.backfillDatabase(session, max_workers=max_workers, client=client, on_conflict=on_conflict)
+    else:
+        dbqueries.updateDatabase(session, max_workers=max_workers, client=client, on_conflict=on_conflict)
+    try:
+        referencedata.update_reference_data(session, ini.loc['station_data'][0])
+    except Exception as e:
+        print(f'Storing reference data failed: {e}')
+    if 'raw_retention_months' in ini.index:
+        partitions.apply_retention(session, 'Sensor_data_raw', int(ini.loc['raw_retention_months'][0]),
+                                   ini.loc['archive_path'][0])
+    backend = ini.loc['rollup_backend'][0] if 'rollup_backend' in ini.index else 'pandas'
     
     # Query data from database (data_all) for report and map
     # -------------------------------------------------------------------------
     
+    report_workers = int(ini.loc['report_workers'][0]) if 'report_workers' in ini.index else 1
+    report_json = bool(int(ini.loc['report_json'][0])) if 'report_json' in ini.index else False
     days = 4 # Number of days from current time for report
-    data_all, dataframe_empty = query_data_for_report(session, days)
+    cache = ini.loc['report_cache'][0] if 'report_cache' in ini.index else None
+    data_all, dataframe_empty = query_data_for_report(session, days, cache)
     if dataframe_empty:
         print('No data found between given date range')
     else:
-        if pd.Timestamp.now().hour == 1:
-            from database import Sensor_data_60
-            date1 = pd.Timestamp.now().floor('D') - datetime.timedelta(days=1) + datetime.timedelta(minutes=1)
-            date2 = pd.Timestamp.now().floor('D') + datetime.timedelta(days=1)
-            dbqueries.delete_rows_between_dates(session, date1, date2, Sensor_data_60)
-            dbqueries.updateDatabase_hour_avg(session)
-            dbqueries.updateDatabase_day_avg(session)
-        else:
-            dbqueries.updateDatabase_hour_avg(session)
+        # Late data is recomputed from dirty buckets, and day averages are
+        # written only once the day is complete
+        dbqueries.updateDatabase_hour_avg(session, backend)
+        dbqueries.updateDatabase_day_avg(session, backend)
+        if 'history_months' in ini.index:
+            for table in archive.HISTORY_TABLES:
+                archive.export_history(session, table, ini.loc['archive_path'][0], int(ini.loc['history_months'][0]))
         
 
-        data_colocation = data_all[data_all.sensor_id.isin(['HSYS001', 'HSYS002', 'HSYS004','HSYS015', 'HSYS017', 'HSYS018', 'HSYS019',
-                                                            'HSYS020', 'HSYS021', 'HSYS022','HSYS023', 'HSYS024'])].copy()
-        data_all = data_all[data_all.loc_id != 'Supersite']
+        data_all = dbqueries.remove_unused_labels(data_all[data_all.loc_id != 'Supersite'].copy())
 
         
         # Generate map and save to file
@@ -91,14 +137,28 @@ def Main():
         # Generate HTML report and save to file
         # ---------------------------------------------------------------------
         
-        html_report.createReport(data_all, ini.loc["station_data"][0], ini.loc["report_online"][0], 
-                                  ini.loc["template_folder"][0], ini.loc["report_template"][0], 18, True)
+        # Hourly averages come from Sensor_data_60, so the report does not
+        # resample minute data (online=False). The current hour is included
+        # and the first hour is a full hour of the hourly rollup.
+        data_hour = dbqueries.queryResolution(session, data_all.index.min().floor('H'), pd.Timestamp.now().ceil('H'), 'H',
+                                              components=REPORT_COLUMNS[:8], compact=True)
+        data_hour = dbqueries.remove_unused_labels(data_hour[data_hour.loc_id != 'Supersite'].copy())
+        html_report.createReport(data_hour, ini.loc["station_data"][0], ini.loc["report_online"][0], 
+                                  ini.loc["template_folder"][0], ini.loc["report_template"][0], 18, False,
+                                  max_workers=report_workers, json_figures=report_json)
         
         
-        html_report.create_colocation_report(data_colocation, ini.loc["station_data"][0], ini.loc["report_colocation"][0], 
-                                              ini.loc["template_folder"][0], ini.loc["colocation_template"][0], 18)
+        # Hourly averages are joined to the reference station in SQL
+        data_colocation = referencedata.queryColocation(session, data_all.index.min().floor('H'),
+                                                        pd.Timestamp.now().ceil('H'), 18, COLOCATION_COLUMNS,
+                                                        sensor_names=COLOCATION_SENSORS)
+        html_report.create_colocation_report(data_colocation, ini.loc["report_colocation"][0], 
+                                              ini.loc["template_folder"][0], ini.loc["colocation_template"][0],
+                                              max_workers=report_workers, json_figures=report_json)
         
         
-Main()
+# Guard is needed by the process pool of report rendering (report_workers)
+if __name__ == '__main__':
+    Main()
 
 #3.0.783
\ No newline at end of file
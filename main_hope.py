@@ -10,9 +10,24 @@ import folium
 import dbqueries
 import airqualitymap
 import html_report
+import reportcache
+import stationdata
+import referencedata
+import partitions
 import os
+from beaconclient import BeaconClient
+from beaconcache import BeaconCache
 
-def query_data_for_report(session, days):
+# Columns used by the report and the map
+REPORT_COLUMNS = ['no2', 'no', 'co', 'o3', 'pm10', 'pm25', 'rh', 'temp',
+                  'co_flag', 'no_flag', 'no2_flag', 'o3_flag', 'pm10_flag', 'pm25_flag']
+
+# Sensors and columns of the colocation report
+COLOCATION_SENSORS = ['AQT02', 'AQT03', 'AQT04', 'AQT30', 'AQT31']
+COLOCATION_COLUMNS = ['no2', 'pm10', 'pm25', 'rh', 'temp']
+
+
+def query_data_for_report(session, days, cache=None):
     date1 = (pd.Timestamp(datetime.datetime.now() - 
                           datetime.timedelta(days=days, 
                             hours=datetime.datetime.now().hour,
@@ -23,7 +38,12 @@ def query_data_for_report(session, days):
     
     sensorLocations = pd.read_sql_table('Location', con=session.bind).set_index('id')
     
-    data_all = dbqueries.queryBetweenDates(session, sensors, sensorLocations, date1, date2)
+    if cache is not None:
+        data_all = reportcache.query_window(session, sensors, sensorLocations, date1, date2, cache,
+                                            columns=REPORT_COLUMNS)
+    else:
+        data_all = dbqueries.queryBetweenDates(session, sensors, sensorLocations, date1, date2,
+                                               columns=REPORT_COLUMNS, compact=True)
         
     return data_all, data_all.empty
 
@@ -52,21 +72,48 @@ def Main():
     ini_file = os.path.join(os.path.dirname(__file__), 'iniFile_HOPE.csv')
     ini = pd.read_csv(ini_file, sep= '\t', index_col=0)
     session = dbqueries.createSession(ini)
+    if 'station_cache' in ini.index:
+        stationdata.CACHE_DIR = ini.loc['station_cache'][0]
     
     # Poll data from Vaisala API and insert to database
     # -------------------------------------------------------------------------
-    dbqueries.updateDatabase(session)
+    max_workers = int(ini.loc['ingest_workers'][0]) if 'ingest_workers' in ini.index else 1
+    deadline = None
+    if 'ingest_minutes' in ini.index:
+        deadline = datetime.datetime.now() + datetime.timedelta(minutes=float(ini.loc['ingest_minutes'][0]))
+    state_file = ini.loc['beacon_state'][0] if 'beacon_state' in ini.index else None
+    cache = None
+    if 'beacon_cache' in ini.index:
+        max_days = float(ini.loc['beacon_cache_days'][0]) if 'beacon_cache_days' in ini.index else None
+        cache = BeaconCache(ini.loc['beacon_cache'][0], max_days=max_days)
+    client = BeaconClient(pool_size=max_workers, deadline=deadline, state_file=state_file, cache=cache)
+    on_conflict = ini.loc['upsert'][0] if 'upsert' in ini.index else 'ignore'
+    partitions.ensure_partitions(session)
+    if 'backfill' in ini.index and int(ini.loc['backfill'][0]):
+        # Sensors with long outages are caught up to current time in windows
+        dbqueries.backfillDatabase(session, max_workers=max_workers, client=client, on_conflict=on_conflict)
+    else:
+        dbqueries.updateDatabase(session, max_workers=max_workers, client=client, on_conflict=on_conflict)
+    try:
+        referencedata.update_reference_data(session, ini.loc['station_data'][0])
+    except Exception as e:
+        print(f'Storing reference data failed: {e}')
+    # The colocation report reads hourly averages from Sensor_data_60
+    backend = ini.loc['rollup_backend'][0] if 'rollup_backend' in ini.index else 'pandas'
+    dbqueries.updateDatabase_hour_avg(session, backend)
     
     # Query data from database (data_all) for report and map
     # -------------------------------------------------------------------------
     
+    report_workers = int(ini.loc['report_workers'][0]) if 'report_workers' in ini.index else 1
+    report_json = bool(int(ini.loc['report_json'][0])) if 'report_json' in ini.index else False
     days = 2 # Number of days from current time for report
-    data_all, dataframe_empty = query_data_for_report(session, days)
+    cache = ini.loc['report_cache'][0] if 'report_cache' in ini.index else None
+    data_all, dataframe_empty = query_data_for_report(session, days, cache)
     if dataframe_empty:
         print('No data found between given date range')
     else:
-        data_colocation = data_all[data_all.sensor_id.isin(['AQT02', 'AQT03', 'AQT04', 'AQT30', 'AQT31'])].copy()
-        data_all = data_all[data_all.loc_id != 'Supersite']
+        data_all = dbqueries.remove_unused_labels(data_all[data_all.loc_id != 'Supersite'].copy())
         
         
         # Generate map and save to file
@@ -80,12 +127,20 @@ def Main():
         # ---------------------------------------------------------------------
         html_report.create_HOPE_report(data_all, ini.loc["station_data"][0], ini.loc["report_online"][0], 
                                   ini.loc["template_folder"][0], ini.loc["report_template"][0],
-                                  station_id=18, online=True, kartta='hopekartta.html', legend_layout='rightside')
+                                  station_id=18, online=True, kartta='hopekartta.html', legend_layout='rightside',
+                                  max_workers=report_workers, json_figures=report_json)
         
-        html_report.create_colocation_report(data_colocation, ini.loc["station_data"][0], ini.loc["report_colocation"][0], 
-                                              ini.loc["template_folder"][0], ini.loc["colocation_template"][0], 18)
+        # Hourly averages are joined to the reference station in SQL
+        data_colocation = referencedata.queryColocation(session, data_all.index.min().floor('H'),
+                                                        pd.Timestamp.now().ceil('H'), 18, COLOCATION_COLUMNS,
+                                                        sensor_names=COLOCATION_SENSORS)
+        html_report.create_colocation_report(data_colocation, ini.loc["report_colocation"][0], 
+                                              ini.loc["template_folder"][0], ini.loc["colocation_template"][0],
+                                              max_workers=report_workers, json_figures=report_json)
         
         return m
         
         
-Main()
+# Guard is needed by the process pool of report rendering (report_workers)
+if __name__ == '__main__':
+    Main()
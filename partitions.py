@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""
+Monthly range partitions of Sensor_data_raw and Sensor_data on timestamp.
+Partitions are named {table}_YYYY_MM. Old partitions are exported to the
+Parquet archive (archive.py) and dropped by apply_retention.
+
+@author: Taneli Mäkelä
+"""
+import datetime
+import pandas as pd
+from sqlalchemy import inspect, text
+from database import Base
+import archive
+
+PARTITIONED = ['Sensor_data_raw', 'Sensor_data']
+
+
+def month_start(timestamp):
+    return pd.Timestamp(timestamp).to_period('M').to_timestamp()
+
+
+def partition_name(table, month):
+    return f'{table}_{month:%Y_%m}'
+
+
+def is_partitioned(connection, table):
+    return connection.execute(text('SELECT 1 FROM pg_partitioned_table WHERE partrelid = CAST(:table AS regclass)'),
+                              {'table': f'"{table}"'}).first() is not None
+
+
+def list_partitions(connection, table):
+    '''
+    Attached monthly partitions of table as dictionary {month start: name}.
+    '''
+    names = connection.execute(text('''SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                                        WHERE i.inhparent = CAST(:table AS regclass)'''),
+                               {'table': f'"{table}"'}).scalars()
+    partitions = {}
+    for name in names:
+        month = pd.to_datetime(name[len(table) + 1:], format='%Y_%m', errors='coerce')
+        if name.startswith(f'{table}_') and not pd.isnull(month):
+            partitions[month] = name
+    return partitions
+
+
+def create_partitions(connection, table, first, last):
+    # Missing partitions for months from first to last (both included)
+    existing = list_partitions(connection, table)
+    for month in pd.date_range(month_start(first), month_start(last), freq='MS'):
+        if month in existing:
+            continue
+        upper = month + pd.DateOffset(months=1)
+        connection.execute(text(f'''CREATE TABLE "{partition_name(table, month)}" PARTITION OF "{table}"
+                                    FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')'''))
+        print(f'Created partition {partition_name(table, month)}')
+
+
+def ensure_partitions(session, months_ahead=2, start=None):
+    '''
+    Creates partitions of partitioned tables from start (default current
+    month) to months_ahead months ahead, so writes never hit a missing
+    partition. Partitions left detached are attached back first. Tables
+    which are not partitioned are skipped.
+    '''
+    now = datetime.datetime.now()
+    first = start if start is not None else now
+    with session.bind.begin() as connection:
+        for table in PARTITIONED:
+            if is_partitioned(connection, table):
+                reattach_detached(connection, table)
+                create_partitions(connection, table, first, month_start(now) + pd.DateOffset(months=months_ahead))
+
+
+def attach_partition(connection, table, name, month):
+    upper = month + pd.DateOffset(months=1)
+    connection.execute(text(f'''ALTER TABLE "{table}" ATTACH PARTITION "{name}"
+                                FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')'''))
+
+
+def reattach_detached(connection, table):
+    # Monthly tables left detached by an interrupted run of an older
+    # apply_retention are attached back, so their rows are queryable and
+    # archived by the next retention
+    names = connection.execute(text('''SELECT relname FROM pg_class
+                                        WHERE relkind = 'r' AND NOT relispartition AND pg_table_is_visible(oid)
+                                          AND relname ~ :pattern'''),
+                               {'pattern': f'^{table}_[0-9]{{4}}_[0-9]{{2}}$'}).scalars().all()
+    for name in names:
+        attach_partition(connection, table, name, pd.to_datetime(name[len(table) + 1:], format='%Y_%m'))
+        print(f'Attached detached partition {name}')
+
+
+def apply_retention(session, table, keep_months, path):
+    '''
+    Partitions of table older than keep_months full months are exported to
+    the Parquet archive at path while still attached, then detached and
+    dropped in one transaction. A partition is dropped only if the archive
+    has all of its rows, otherwise it stays attached and is exported again
+    next time. An interrupted run never leaves a partition detached.
+    '''
+    cutoff = month_start(datetime.datetime.now()) - pd.DateOffset(months=keep_months)
+    with session.bind.begin() as connection:
+        if not is_partitioned(connection, table):
+            print(f'{table} is not partitioned, retention skipped')
+            return
+        reattach_detached(connection, table)
+        old = {month: name for month, name in list_partitions(connection, table).items() if month < cutoff}
+
+    for month, name in sorted(old.items()):
+        try:
+            rows = archive.export_query(session, f'SELECT * FROM "{name}"', path, table, name)
+            with session.bind.begin() as connection:
+                # Lock keeps late rows out between the count and the drop
+                connection.execute(text(f'LOCK TABLE "{name}" IN ACCESS EXCLUSIVE MODE'))
+                stored = connection.execute(text(f'SELECT count(*) FROM "{name}"')).scalar()
+                if archive.count_rows(path, table, month.year, month.month) < stored:
+                    raise ValueError(f'archive of {name} has {rows} rows, partition {stored}')
+                connection.execute(text(f'ALTER TABLE "{table}" DETACH PARTITION "{name}"'))
+                connection.execute(text(f'DROP TABLE "{name}"'))
+        except Exception as e:
+            print(f'Archiving {name} failed, partition kept: {e}')
+            continue
+        print(f'{name} archived ({rows} rows) and dropped')
+
+
+def partition_existing(engine, table):
+    '''
+    Converts an existing unpartitioned table to a partitioned one in one
+    transaction: old table, its constraints, indexes and id sequence are
+    renamed, the partitioned table and partitions for all months with data
+    are created and rows are copied. Locks the table for the whole copy.
+    '''
+    suffix = '_unpartitioned'
+    legacy = table + suffix
+    inspector = inspect(engine)
+    indexes = [index['name'] for index in inspector.get_indexes(table)]
+    constraints = ([constraint['name'] for constraint in inspector.get_unique_constraints(table)] +
+                   [inspector.get_pk_constraint(table)['name']])
+    columns = ', '.join(f'"{column.name}"' for column in Base.metadata.tables[table].columns)
+
+    with engine.begin() as connection:
+        if is_partitioned(connection, table):
+            print(f'{table} is already partitioned')
+            return
+        connection.execute(text(f'ALTER TABLE "{table}" RENAME TO "{legacy}"'))
+        for name in constraints:
+            connection.execute(text(f'ALTER TABLE "{legacy}" RENAME CONSTRAINT "{name}" TO "{name}{suffix}"'))
+        for name in indexes:
+            if name not in constraints:
+                connection.execute(text(f'ALTER INDEX "{name}" RENAME TO "{name}{suffix}"'))
+        connection.execute(text(f'ALTER SEQUENCE IF EXISTS "{table}_id_seq" RENAME TO "{table}_id_seq{suffix}"'))
+
+        Base.metadata.tables[table].create(connection)
+        first, last = connection.execute(text(f'SELECT min(timestamp), max(timestamp) FROM "{legacy}"')).first()
+        now = datetime.datetime.now()
+        create_partitions(connection, table, first or now, max(last or now, now))
+        copied = connection.execute(text(f'INSERT INTO "{table}" ({columns}) SELECT {columns} FROM "{legacy}"')).rowcount
+        connection.execute(text(f'''SELECT setval('"{table}_id_seq"', (SELECT coalesce(max(id), 0) + 1 FROM "{table}"), false)'''))
+        connection.execute(text(f'DROP TABLE "{legacy}"'))
+    print(f'{table} partitioned, {copied} rows copied')
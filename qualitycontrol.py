@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Rule based quality control of sensor data. Rules are read from qc_rules.csv.
+
+@author: Taneli Mäkelä
+"""
+import os
+import functools
+import numpy as np
+import pandas as pd
+
+RULES_FILE = os.path.join(os.path.dirname(__file__), 'qc_rules.csv')
+
+# Flag codes written to *_flag columns. 0 is valid data, every other code
+# makes the value invalid. When several rules hit, the largest code is kept.
+RANGE_FLAG = 2      # value outside low - high
+STUCK_FLAG = 3      # same value repeated at least stuck_minutes
+STEP_FLAG = 4       # change from previous value more than max_step per minute
+
+
+@functools.lru_cache()
+def load_rules(path=RULES_FILE):
+    '''
+    Reads QC rules, one row per component and sensor model (device column of
+    Sensor table, empty for all models). Empty limits are not checked.
+    Device specific rules replace general rules of the same component.
+    '''
+    rules = pd.read_csv(path, sep=';', dtype={'component': str, 'device': str})
+    rules['device'] = rules['device'].fillna('')
+    return rules
+
+
+def history_minutes(rules=None):
+    # Minutes of stored data needed before a batch, so that stuck runs which
+    # started in an earlier batch are measured in full
+    if rules is None:
+        rules = load_rules()
+    longest = rules['stuck_minutes'].max()
+    return 0 if np.isnan(longest) else int(longest)
+
+
+def run_minutes(values, minutes, new_sensor):
+    # Length in minutes of the run of identical values each row belongs to.
+    # Runs are found with one pass of run-length encoding over the frame. A
+    # gap of missing minutes ends the run.
+    previous = np.r_[np.nan, values[:-1]]
+    gap = np.diff(minutes, prepend=minutes[:1]) > 1
+    starts = new_sensor | (values != previous) | gap
+    run = np.cumsum(starts) - 1
+    first = np.flatnonzero(starts)
+    last = np.r_[first[1:], len(values)] - 1
+    return (minutes[last] - minutes[first] + 1)[run]
+
+
+def step_per_minute(values, minutes, new_sensor):
+    step = np.abs(np.diff(values, prepend=np.nan)) / np.maximum(np.diff(minutes, prepend=0), 1)
+    step[new_sensor] = 0
+    return step
+
+
+def evaluate(data, rules=None, devices=None, history=None):
+    '''
+    Evaluates QC rules for a frame with any number of sensors and writes the
+    largest hit flag code to *_flag columns (existing flags are kept). All
+    rules are vectorized over the whole frame sorted by sensor and time, so
+    cost is linear in number of rows. devices maps sensor_id to sensor model.
+    history holds stored rows just before data (history_minutes); they are
+    used as context only and not returned.
+    '''
+    if rules is None:
+        rules = load_rules()
+    df = data.copy()
+    if df.empty:
+        return df
+    if history is not None and not history.empty:
+        context = history[[column for column in df.columns if column in history.columns]]
+        df = pd.concat([context, df], ignore_index=True)
+        return evaluate(df, rules, devices).iloc[len(context):].set_axis(data.index)
+
+    order = np.lexsort((df['timestamp'].to_numpy(), df['sensor_id'].to_numpy()))
+    sensor = df['sensor_id'].to_numpy()[order]
+    minutes = pd.to_datetime(df['timestamp']).values.astype('datetime64[m]').astype(np.int64)[order]
+    new_sensor = np.r_[True, sensor[1:] != sensor[:-1]]
+    if devices is not None:
+        device = pd.Series(sensor).map(devices).fillna('').to_numpy(dtype=str)
+    else:
+        device = np.full(len(df), '')
+
+    for component, component_rules in rules.groupby('component'):
+        if component not in df.columns:
+            continue
+        values = df[component].to_numpy(dtype=float)[order]
+        valid = ~np.isnan(values)
+        flags = np.zeros(len(df), dtype=np.int8)
+        specific = [rule_device for rule_device in component_rules['device'] if rule_device]
+
+        for rule in component_rules.itertuples():
+            if rule.device:
+                rows = device == rule.device
+            else:
+                rows = ~np.isin(device, specific)
+            if not np.isnan(rule.low):
+                flags[rows & (values < rule.low)] = RANGE_FLAG
+            if not np.isnan(rule.high):
+                flags[rows & (values > rule.high)] = RANGE_FLAG
+            if not np.isnan(rule.stuck_minutes):
+                stuck = rows & valid & (run_minutes(values, minutes, new_sensor) >= rule.stuck_minutes)
+                flags[stuck] = np.maximum(flags[stuck], STUCK_FLAG)
+            if not np.isnan(rule.max_step):
+                jump = rows & valid & (step_per_minute(values, minutes, new_sensor) > rule.max_step)
+                flags[jump] = np.maximum(flags[jump], STEP_FLAG)
+
+        column = component + '_flag'
+        result = np.zeros(len(df), dtype=np.int8)
+        result[order] = flags
+        if column in df.columns:
+            result = np.maximum(result, df[column].fillna(0).to_numpy(dtype=np.int8))
+        df[column] = result
+    return df
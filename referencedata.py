@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Reference station data in the database. Rows of the ilmanet CSV are stored
+to Reference_data (one row per station, component and hour), each run
+writing only the hours after the latest stored hour of each station and
+component. Hourly sensor averages are joined to them in SQL over the whole
+history (queryColocation) instead of the window the CSV happens to export.
+
+@author: Taneli Mäkelä
+"""
+import datetime
+import pandas as pd
+from sqlalchemy import select, text
+from database import Reference_data, Sensor_data_60, Sensor, Location
+from bulkwriter import frame_to_csv
+import stationdata
+
+# Hours before the latest stored hour that are written again, so values
+# the station publishes late or corrects replace the stored ones
+OVERLAP = datetime.timedelta(hours=6)
+
+# Components the reference stations measure for colocation
+REFERENCE_COMPONENTS = ['no', 'no2', 'pm10', 'pm25', 'o3']
+
+UPSERT = '''INSERT INTO "Reference_data" (station_id, component, timestamp, value)
+            SELECT station_id, component, timestamp, value FROM "tmp_Reference_data"
+            ON CONFLICT (station_id, component, timestamp) DO UPDATE SET value = EXCLUDED.value'''
+
+
+def to_long(data):
+    '''
+    Wide read_ilmanetcsv frame (columns station, component) to rows of
+    Reference_data. Missing values (-9999) and columns that are not
+    numbered stations are dropped.
+    '''
+    data = data.copy()
+    data.columns = pd.MultiIndex.from_tuples([(str(station), str(component)) for station, component in data.columns])
+    data = data.loc[:, [station.isdigit() for station in data.columns.get_level_values(0)]]
+    data.columns.names = ['station_id', 'component']
+    data.index.name = 'timestamp'
+    rows = data.stack(['station_id', 'component']).rename('value').reset_index()
+    rows = rows[rows['value'] != -9999].dropna(subset=['value'])
+    rows['station_id'] = rows['station_id'].astype(int)
+    return rows[['station_id', 'component', 'timestamp', 'value']]
+
+
+def load_reference_watermarks(session):
+    # Latest stored hour of each station and component. Components of one
+    # station are published at different delays, so each has its own
+    # watermark. The primary key (station_id, component, timestamp) orders
+    # the rows of each group by time.
+    Reference_data.__table__.create(session.bind, checkfirst=True)
+    with session.bind.connect() as connection:
+        latest = connection.execute(text('''SELECT station_id, component, max(timestamp) FROM "Reference_data"
+                                            GROUP BY station_id, component'''))
+        return {(station_id, component): pd.Timestamp(timestamp) for station_id, component, timestamp in latest}
+
+
+def write_reference(session, rows):
+    # COPY to a temporary table and upsert in one transaction
+    if rows.empty:
+        return 0
+    connection = session.bind.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMP TABLE "tmp_Reference_data" ON COMMIT DROP AS '
+                           'SELECT station_id, component, timestamp, value FROM "Reference_data" WITH NO DATA')
+            cursor.copy_expert('COPY "tmp_Reference_data" (station_id, component, timestamp, value) '
+                               'FROM STDIN WITH (FORMAT csv)', frame_to_csv('Reference_data', rows))
+            cursor.execute(UPSERT)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return len(rows)
+
+
+def update_reference_data(session, source, overlap=OVERLAP):
+    '''
+    Stores new hours of the station CSV at source (URL or file) to
+    Reference_data. The CSV is read through stationdata, so the reports of
+    the same run reuse the parsed frame. Returns number of rows written.
+    '''
+    rows = to_long(stationdata.read_ilmanetcsv(source))
+    watermarks = load_reference_watermarks(session)
+    keys = pd.Series(list(zip(rows['station_id'], rows['component'])), index=rows.index)
+    first = pd.to_datetime(keys.map(watermarks)) - overlap
+    rows = rows[first.isna() | (rows['timestamp'] > first)]
+    rows = rows.drop_duplicates(subset=['station_id', 'component', 'timestamp'], keep='last')
+    written = write_reference(session, rows)
+    print(f'{written} reference rows written for {rows["station_id"].nunique()} stations')
+    return written
+
+
+def colocation_statement(date1, date2, station_id, components, sensor_names=None):
+    # Hourly averages of sensors with the reference value of the same hour
+    # as column {component}_reference, joined on station, component and
+    # timestamp. Hours without a reference value are kept with NULL.
+    selected = [Sensor_data_60.timestamp, Sensor.name.label('sensor_id'), Location.name.label('loc_id')]
+    joined = Sensor_data_60.__table__.join(Sensor.__table__, Sensor.id == Sensor_data_60.sensor_id).join(
+        Location.__table__, Location.id == Sensor_data_60.loc_id)
+    for component in components:
+        selected.append(Sensor_data_60.__table__.columns[component])
+        if component in REFERENCE_COMPONENTS:
+            reference = Reference_data.__table__.alias(f'reference_{component}')
+            selected.append(reference.c.value.label(f'{component}_reference'))
+            joined = joined.outerjoin(reference, (reference.c.timestamp == Sensor_data_60.timestamp) &
+                                                 (reference.c.station_id == int(station_id)) &
+                                                 (reference.c.component == component))
+    statement = select(*selected).select_from(joined).where(Sensor_data_60.timestamp.between(date1, date2))
+    if sensor_names is not None:
+        statement = statement.where(Sensor.name.in_(list(sensor_names)))
+    return statement.order_by(Sensor_data_60.timestamp, Sensor.name)
+
+
+def queryColocation(session, date1, date2, station_id, components, sensor_names=None):
+    '''
+    Hourly averages (Sensor_data_60) of components between dates with the
+    reference value of station_id in column {component}_reference for
+    REFERENCE_COMPONENTS, indexed by timestamp (end of the hour). Sensor and
+    location names are in sensor_id and loc_id as in queryBetweenDates.
+    '''
+    data = pd.read_sql(colocation_statement(date1, date2, station_id, components, sensor_names), session.bind)
+    data.index = pd.to_datetime(data['timestamp'])
+    # Columns without any reference value are read as object
+    references = [column for column in data.columns if column.endswith('_reference')]
+    data[references] = data[references].astype(float)
+    return data.drop(columns='timestamp')
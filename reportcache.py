@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of the report window (queryBetweenDates frame of last days) in
+a Parquet file, so each run reads only the newest minutes from the database.
+Needs pyarrow.
+
+@author: Taneli Mäkelä
+"""
+import os
+import json
+import datetime
+import pandas as pd
+import dbqueries
+
+# Cached rows newer than high-water mark - OVERLAP are read again, so late
+# and recomputed rows replace the cached ones
+OVERLAP = datetime.timedelta(hours=2)
+
+
+def read_cache(path, columns):
+    # Cache is used only if it was written with the same columns
+    manifest = path + '.json'
+    if not os.path.exists(path) or not os.path.exists(manifest):
+        return None, None
+    with open(manifest) as f:
+        info = json.load(f)
+    if info['columns'] != columns:
+        return None, None
+    return pd.read_parquet(path), pd.Timestamp(info['start'])
+
+
+def write_cache(path, data, start, columns):
+    data.to_parquet(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    with open(path + '.json.tmp', 'w') as f:
+        json.dump({'start': start.isoformat(), 'columns': columns}, f)
+    os.replace(path + '.json.tmp', path + '.json')
+
+
+def query_window(session, sensors, locations, date1, date2, path, columns=None, compact=True, overlap=OVERLAP):
+    '''
+    queryBetweenDates(date1, date2) using cache file at path (one file per
+    deployment). Only rows after the cached high-water mark minus overlap
+    are queried. Rows older than date1 are evicted and the merged frame is
+    written back to the cache.
+    '''
+    date1, date2 = pd.Timestamp(date1), pd.Timestamp(date2)
+    try:
+        cached, start = read_cache(path, columns)
+    except Exception as e:
+        print(f'Reading report cache failed: {e}')
+        cached, start = None, None
+    if cached is None or cached.empty or start > date1:
+        fetch_from = date1
+        cached = None
+    else:
+        fetch_from = max(date1, cached.index.max() - overlap)
+        cached = cached[(cached.index >= date1) & (cached.index < fetch_from)]
+
+    new = dbqueries.queryBetweenDates(session, sensors, locations, fetch_from, date2, columns=columns, compact=compact)
+    if cached is not None and not cached.empty:
+        data = pd.concat([cached, new])
+        if compact:
+            data = dbqueries.compact_frame(data)
+    else:
+        data = new
+    print(f'Report window: {len(cached) if cached is not None else 0} rows from cache, {len(new)} from database')
+
+    try:
+        write_cache(path, data, date1, columns)
+    except Exception as e:
+        print(f'Writing report cache failed: {e}')
+    return data
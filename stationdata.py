@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Reference station data (ilmanet CSV export) shared by the map and the
+reports. The CSV is downloaded and parsed once per run. With CACHE_DIR set
+the download is kept on disk and revalidated with ETag / Last-Modified, so
+an unchanged export is not downloaded again on the next run.
+
+@author: Taneli Mäkelä
+"""
+import io
+import os
+import json
+import hashlib
+import datetime
+import requests
+import pandas as pd
+
+# Directory for downloaded CSV files, None keeps them only in memory
+CACHE_DIR = None
+
+# Downloads of this run: {source: (content, version)}. Each URL is
+# downloaded once per run, later calls use the same content.
+_downloads = {}
+
+# Parsed frames of this run: {(source, version): frame}
+_parsed = {}
+
+
+def is_url(source):
+    return str(source).startswith(('http://', 'https://', 'www.'))
+
+
+def download(source):
+    '''
+    Returns (CSV content, version) of an URL. A cached copy is sent back
+    with conditional request headers and used if the server answers 304.
+    '''
+    url = source if str(source).startswith('http') else 'https://' + source
+    cached = None
+    headers = {}
+    if CACHE_DIR is not None:
+        cached = os.path.join(CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        if os.path.exists(cached + '.csv') and os.path.exists(cached + '.json'):
+            with open(cached + '.json') as f:
+                validators = json.load(f)
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+    response = requests.get(url, headers=headers, timeout=(5, 120))
+    if response.status_code == 304:
+        with open(cached + '.csv', 'rb') as f:
+            content = f.read()
+        print('Station data not modified, using cached copy')
+    else:
+        response.raise_for_status()
+        content = response.content
+        if cached is not None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cached + '.csv.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(cached + '.csv.tmp', cached + '.csv')
+            with open(cached + '.json', 'w') as f:
+                json.dump({'etag': response.headers.get('ETag'),
+                           'last_modified': response.headers.get('Last-Modified')}, f)
+    return content, hashlib.sha1(content).hexdigest()
+
+
+def parse_ilmanetcsv(source):
+    '''
+    Parses ilmanet CSV (three header rows, timestamps as dd.mm.yyyy HH:MM
+    where midnight is written as 24:00 of the previous day).
+    '''
+    data = pd.read_csv(source, header=[0,1,2])
+    data = data.drop(columns=data.filter(like='22').columns)
+    data.columns = data.columns.droplevel(1)
+
+    # 24:00 is parsed as 00:00 and moved to the next day for all rows at once
+    stamps = data.iloc[:, 0].astype(str)
+    end_of_day = stamps.str.contains('24:00', regex=False)
+    timestamps = pd.to_datetime(stamps.str.replace('24:00', '00:00', regex=False), format="%d.%m.%Y %H:%M")
+    timestamps = timestamps + pd.to_timedelta(end_of_day.astype(int), unit='D')
+    data.iloc[:, 0] = timestamps
+    data = data.set_index(pd.DatetimeIndex(timestamps, name=data.columns[0]))
+
+    data = data.apply(pd.to_numeric, errors='coerce')
+    data = data.rename(columns=str.lower).rename(columns={'pm2_5': 'pm25'})
+    data.sort_index(inplace=True)
+    return data
+
+
+def read_ilmanetcsv(source):
+    '''
+    Station data frame of source (URL or file). Every call of a run gets a
+    copy of the same parsed frame. An URL is downloaded once per run, a file
+    is read again only if it has changed.
+    '''
+    if is_url(source):
+        if source not in _downloads:
+            _downloads[source] = download(source)
+        content, version = _downloads[source]
+    else:
+        content, version = None, os.path.getmtime(source)
+
+    key = (source, version)
+    if key not in _parsed:
+        start = datetime.datetime.now()
+        _parsed.clear()
+        _parsed[key] = parse_ilmanetcsv(io.BytesIO(content) if content is not None else source)
+        print(f'Station data parsed in {(datetime.datetime.now() - start).total_seconds():.1f} s')
+    return _parsed[key].copy()
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+Modules are flat at the repository root.
+
+@author: Taneli Mäkelä
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
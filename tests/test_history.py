@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+History store reads through queryHistory. Archive pieces are written with
+export_frame and recent rows are in an SQLite table created with to_sql.
+
+@author: Taneli Mäkelä
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import archive
+import dbqueries
+from database import Sensor_data
+
+pytest.importorskip('pyarrow.dataset', exc_type=ImportError)
+
+
+def rows(start, minutes, sensor_id, first_id=0):
+    data = pd.DataFrame({column.name: np.nan for column in Sensor_data.__table__.columns},
+                        index=range(minutes))
+    data['id'] = range(first_id, first_id + minutes)
+    data['timestamp'] = pd.date_range(start, periods=minutes, freq='T')
+    data['sensor_id'] = sensor_id
+    data['loc_id'] = sensor_id
+    data['no2'] = 10.0
+    data['pm1'] = 3.0
+    for column in data.columns:
+        if column.endswith('_flag'):
+            data[column] = 0
+    return data
+
+
+def test_history_reads_archive_pieces_with_all_null_column(tmp_path):
+    engine = create_engine('sqlite://')
+    pd.DataFrame({'id': [1, 2], 'name': ['S1', 'S2']}).to_sql('Sensor', engine, index=False)
+    pd.DataFrame({'id': [1, 2], 'name': ['L1', 'L2']}).to_sql('Location', engine, index=False)
+    session = sessionmaker(bind=engine)()
+    sensors = pd.DataFrame({'name': ['S1', 'S2']}, index=[1, 2])
+    locations = pd.DataFrame({'name': ['L1', 'L2']}, index=[1, 2])
+
+    # Legacy sensor without pm1: read_sql gives an object column of NULLs
+    legacy = rows('2024-01-01', 10, 1)
+    legacy['pm1'] = pd.Series([None] * len(legacy), dtype=object)
+    archive.export_frame(legacy, str(tmp_path), 'Sensor_data', 'piece_0')
+    archive.export_frame(rows('2024-01-01', 10, 2, first_id=10), str(tmp_path), 'Sensor_data', 'piece_1')
+    archive.set_archived_until(str(tmp_path), 'Sensor_data', '2024-01-02')
+    assert archive.count_rows(str(tmp_path), 'Sensor_data', 2024, 1) == 20
+
+    rows('2024-01-02', 5, 1, first_id=20).to_sql('Sensor_data', engine, index=False)
+
+    data = dbqueries.queryHistory(session, sensors, locations, '2024-01-01', '2024-01-02 23:59', str(tmp_path))
+    assert len(data) == 25
+    assert data.index.is_monotonic_increasing
+    assert data.loc[data['sensor_id'] == 'S1', 'pm1'].iloc[:10].isna().all()
+    assert (data.loc[data['sensor_id'] == 'S2', 'pm1'] == 3.0).all()
+    assert set(data['loc_id']) == {'L1', 'L2'}
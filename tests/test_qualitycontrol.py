@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Stuck value rule over ingest batches. Stored rows are read from SQLite
+tables created with to_sql.
+
+@author: Taneli Mäkelä
+"""
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import aggregation
+import dbqueries
+import qualitycontrol
+
+
+def batch(start, minutes, value=12.5):
+    data = pd.DataFrame({'timestamp': pd.date_range(start, periods=minutes, freq='T'),
+                         'sensor_id': 1, 'loc_id': 1})
+    for column in aggregation.MEASUREMENTS:
+        data[column] = np.nan
+    data['no2'] = value
+    return data
+
+
+def stored_session(rows):
+    engine = create_engine('sqlite://')
+    rows.assign(id=range(len(rows))).to_sql('Sensor_data', engine, index=False)
+    return sessionmaker(bind=engine)()
+
+
+def test_stuck_run_spanning_two_batches_is_flagged():
+    first = dbqueries.flagErrorData(batch('2024-01-01 00:00', 30))
+    assert (first['no2_flag'] == 0).all()
+    session = stored_session(first)
+
+    second = batch('2024-01-01 00:30', 20)
+    flagged = dbqueries.flagErrorData(second, history=dbqueries.qc_history(session, second))
+    assert flagged.index.equals(second.index)
+    # The run is 50 minutes long with the stored rows, every row of it is stuck
+    assert (flagged['no2_flag'] == qualitycontrol.STUCK_FLAG).all()
+
+    # Without stored rows the second batch alone is too short
+    assert (dbqueries.flagErrorData(second)['no2_flag'] == 0).all()
+
+
+def test_gap_ends_stuck_run():
+    data = pd.concat([batch('2024-01-01 00:00', 30), batch('2024-01-01 00:40', 30)], ignore_index=True)
+    assert (dbqueries.flagErrorData(data)['no2_flag'] == 0).all()
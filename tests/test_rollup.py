@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Rollup of dirty buckets. Tables are created with to_sql in SQLite, the
+PostgreSQL statement of backend='sql' is only checked for its joins.
+
+@author: Taneli Mäkelä
+"""
+import re
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+import aggregation
+from database import Sensor_data, Dirty_bucket
+from dirtybuckets import dirty_ranges, clear_dirty_ranges, load_dirty
+from watermarks import TARGETS
+
+
+def dirty_frame():
+    # Two late hours of the same sensor
+    return pd.DataFrame({'sensor_id': [1, 1],
+                         'timestamp': pd.to_datetime(['2024-01-01 03:00', '2024-01-01 06:00'])})
+
+
+def test_two_dirty_buckets_give_two_ranges():
+    ranges = dirty_ranges(dirty_frame(), 'Sensor_data_60', [(1, pd.Timestamp('2024-01-02'), pd.Timestamp('2024-01-02 10:00'))])
+    assert ranges == [(1, pd.Timestamp('2024-01-01 02:00'), pd.Timestamp('2024-01-01 02:59')),
+                      (1, pd.Timestamp('2024-01-01 05:00'), pd.Timestamp('2024-01-01 05:59'))]
+
+
+def test_pandas_rollup_of_two_dirty_buckets_has_one_row_per_bucket():
+    timestamps = pd.date_range('2024-01-01 00:00', '2024-01-01 08:00', freq='T')
+    data = pd.DataFrame({'id': range(len(timestamps)), 'sensor_id': 1, 'loc_id': 7, 'timestamp': timestamps})
+    for column in aggregation.MEASUREMENTS:
+        data[column] = 1.0
+    for flag in aggregation.FLAGS:
+        data[flag] = 0
+    engine = create_engine('sqlite://')
+    data.to_sql('Sensor_data', engine, index=False)
+    session = sessionmaker(bind=engine)()
+
+    ranges = dirty_ranges(dirty_frame(), 'Sensor_data_60', [])
+    result = aggregation.hourly_averages(aggregation.read_pending(session, Sensor_data, ranges), {1: 7}, fill=False)
+    assert not result.duplicated(subset=['sensor_id', 'timestamp']).any()
+    assert result['timestamp'].tolist() == list(pd.to_datetime(['2024-01-01 03:00', '2024-01-01 06:00']))
+    assert (result['loc_id'] == 7).all()
+
+
+def test_sql_rollup_joins_locations_once_per_sensor():
+    # Joining the inserted buckets to ranges would repeat each bucket once
+    # per range of the sensor, which ON CONFLICT DO UPDATE rejects
+    for fill in (True, False):
+        statement = aggregation.rollup_statement('Sensor_data_60', 2, fill)
+        inserted = statement[statement.index('inserted AS'):]
+        assert re.search(r'JOIN ranges\b', inserted) is None
+        assert 'SELECT DISTINCT sensor_id, loc_id FROM ranges' in statement
+
+
+def test_adjacent_dirty_buckets_are_merged():
+    # A replay over two days marks 48 consecutive hours, plus one apart
+    hours = pd.date_range('2024-01-01 01:00', periods=48, freq='H').append(pd.DatetimeIndex(['2024-01-05 12:00']))
+    dirty = pd.DataFrame({'sensor_id': [1] * len(hours) + [2], 'timestamp': hours.append(pd.DatetimeIndex(['2024-01-01 01:00']))})
+    ranges = dirty_ranges(dirty, 'Sensor_data_60', [])
+    assert ranges == [(1, pd.Timestamp('2024-01-01 00:00'), pd.Timestamp('2024-01-02 23:59')),
+                      (1, pd.Timestamp('2024-01-05 11:00'), pd.Timestamp('2024-01-05 11:59')),
+                      (2, pd.Timestamp('2024-01-01 00:00'), pd.Timestamp('2024-01-01 00:59'))]
+
+
+def test_ranges_are_split_to_batches():
+    ranges = [(i, pd.Timestamp('2024-01-01'), pd.Timestamp('2024-01-02')) for i in range(aggregation.MAX_RANGES * 2 + 1)]
+    sizes = [len(batch) for batch in aggregation.batches(ranges)]
+    assert sizes == [aggregation.MAX_RANGES, aggregation.MAX_RANGES, 1]
+
+
+def test_dirty_buckets_of_a_batch_are_cleared():
+    engine = create_engine('sqlite://')
+    session = sessionmaker(bind=engine)()
+    dirty = pd.DataFrame({'sensor_id': [1, 1, 2],
+                          'timestamp': pd.to_datetime(['2024-01-01 03:00', '2024-01-01 04:00', '2024-01-01 03:00'])})
+    Dirty_bucket.__table__.create(engine)
+    with engine.begin() as connection:
+        connection.execute(Dirty_bucket.__table__.insert(), [
+            {'sensor_id': row.sensor_id, 'target': TARGETS['Sensor_data_60'], 'timestamp': row.timestamp.to_pydatetime()}
+            for row in dirty.itertuples()])
+
+    ranges = dirty_ranges(dirty, 'Sensor_data_60', [])
+    clear_dirty_ranges(session, 'Sensor_data_60', ranges[:1])
+    left = load_dirty(session, 'Sensor_data_60', pd.Timestamp('2024-01-02'))
+    assert left['sensor_id'].tolist() == [2]
+
+
+def test_averages_without_locations_keep_location_of_rows():
+    # Sensor moved from location 7 to 8 at 01:00
+    timestamps = pd.date_range('2024-01-01 00:00', '2024-01-01 01:59', freq='T')
+    data = pd.DataFrame({'sensor_id': 1, 'timestamp': timestamps,
+                         'loc_id': [7 if t.hour == 0 else 8 for t in timestamps]})
+    for column in aggregation.MEASUREMENTS:
+        data[column] = 1.0
+    for flag in aggregation.FLAGS:
+        data[flag] = 0
+    for fill in (True, False):
+        result = aggregation.hourly_averages(data, None, fill)
+        assert result['loc_id'].tolist() == [7, 8]
+    assert aggregation.hourly_averages(data, {1: 9}, False)['loc_id'].tolist() == [9, 9]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Ingest watermarks: latest stored timestamp of each sensor in raw, hourly and
+daily tables, kept in Ingest_state table.
+
+@author: Taneli Mäkelä
+"""
+import pandas as pd
+from sqlalchemy import inspect, text
+from database import Ingest_state
+
+# Watermark target names of the measurement tables
+TARGETS = {'Sensor_data_raw': 'raw', 'Sensor_data_60': '60', 'Sensor_data_1440': '1440'}
+
+UPSERT = '''INSERT INTO "Ingest_state" (sensor_id, target, timestamp) VALUES (%s, %s, %s)
+            ON CONFLICT (sensor_id, target) DO UPDATE
+            SET timestamp = GREATEST("Ingest_state".timestamp, EXCLUDED.timestamp)'''
+
+
+def load_watermarks(session):
+    '''
+    Loads all resume points with one query. Returns dictionary
+    {(sensor_id, target): timestamp}. If Ingest_state table does not exist
+    yet or is empty (e.g. created by migrate_database) it is filled from
+    the measurement tables.
+    '''
+    if not inspect(session.bind).has_table(Ingest_state.__tablename__):
+        rebuild_watermarks(session)
+
+    state = pd.read_sql(session.query(Ingest_state).statement, session.bind)
+    if state.empty:
+        rebuild_watermarks(session)
+        state = pd.read_sql(session.query(Ingest_state).statement, session.bind)
+    return {(row.sensor_id, row.target): pd.Timestamp(row.timestamp) for row in state.itertuples()}
+
+
+def rebuild_watermarks(session, tables=tuple(TARGETS)):
+    '''
+    (Re)creates watermarks of given tables with a single GROUP BY sensor_id
+    query per table.
+    '''
+    Ingest_state.__table__.create(session.bind, checkfirst=True)
+    with session.bind.begin() as connection:
+        for table in tables:
+            target = TARGETS[table]
+            connection.execute(text('DELETE FROM "Ingest_state" WHERE target = :target'), {'target': target})
+            connection.execute(text(f'''INSERT INTO "Ingest_state" (sensor_id, target, timestamp)
+                                        SELECT sensor_id, :target, max(timestamp) FROM "{table}"
+                                        GROUP BY sensor_id'''), {'target': target})
+    print(f'Watermarks rebuilt for {", ".join(tables)}')
+
+
+def update_watermarks(cursor, table, data):
+    # Called inside the transaction of the write, so watermark moves only
+    # if the data is stored
+    if table not in TARGETS or data.empty:
+        return
+    latest = data.groupby('sensor_id')['timestamp'].max()
+    cursor.executemany(UPSERT, [(int(sensor_id), TARGETS[table], pd.Timestamp(timestamp).to_pydatetime())
+                                for sensor_id, timestamp in latest.items()])
+
+
+def resume_time(watermarks, sensor_id, table):
+    return watermarks.get((sensor_id, TARGETS[table]))